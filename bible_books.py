@@ -1,9 +1,98 @@
 """
 Objects for Bible book naming systems
-TODO: Need a strategy for adding Deuterocanon and getting the right sort.
-39.1, 39.2, 39.3, etc?
+Books are numbered 1-66 in the Protestant order. The Deuterocanon and the
+other Apocrypha are numbered after the book they follow (16.1 Tobit after
+Nehemiah, 17.1 1 Maccabees after Esther, 27.1 the Prayer of Azariah after
+Daniel), and every system uses the same number for the same book. Sort
+books or references in the order of a tradition with canon_ranks, not by
+their numbers.
+
+Making a system works through the dictionaries of all its parents, so
+where the same system is used over and over, get the shared copy instead:
+book_name_system(THPFullName, nbs=u'\u00a0')
 """
 import codecs
+import re
+import threading
+import unicodedata
+
+# What can separate the words of a book name (1 John, Song of Songs): a
+# space, a no-break space or another unicode space, or the <nbs/> element
+# from the db's xml. So that a binder needs only one copy of each system:
+# - text is searched with every one-character space turned into a plain
+#   space (normalize_spaces, which doesn't move anything), and patterns
+#   match separator wherever a name has a space
+# - names are looked up with every separator turned into a plain space
+#   (normalize_separators)
+space_characters = u'\t\u00a0\u1680\u2000\u2001\u2002\u2003\u2004\u2005' \
+    u'\u2006\u2007\u2008\u2009\u200a\u202f\u205f\u3000'
+space_table = dict([(ord(c), u' ') for c in space_characters])
+separator = u'(?: |<nbs/>)'
+separator_pattern = re.compile(u'(?:<nbs/>|[ %s])+' % space_characters)
+
+def normalize_spaces(text):
+    """
+    Return the text with every kind of one-character space turned into a
+    plain space. The result is the same length, so offsets into it are
+    offsets into the text.
+    """
+    if isinstance(text, unicode):
+        return text.translate(space_table)
+    return text
+
+def normalize_separators(name):
+    """
+    Return the name with every separator turned into a plain space
+    """
+    return separator_pattern.sub(u' ', name)
+
+def lookup_key(name):
+    """
+    Return the form book names are matched and looked up in: separators
+    made plain spaces, accents dropped, lower case. Every spelling that
+    differs only in those ways (GENESIS, gEnesis, Genesis, genesis) has the
+    same key.
+    """
+    name = normalize_separators(name)
+    try:
+        name.encode('ascii')
+    except UnicodeError:
+        name = u''.join([c for c in unicodedata.normalize('NFKD', name)
+            if not unicodedata.combining(c)])
+    return name.lower()
+
+# The order of the books in each tradition. Books a tradition doesn't count
+# as scripture go where its Bibles print them: protestant between the
+# testaments (as in the NRSV Apocrypha), catholic and orthodox in an
+# appendix after the Old Testament.
+canon_orders = {
+    'protestant': range(1, 40) + [16.1, 16.2, 17.5, 22.1, 22.2, 25.1, 24.1,
+        27.1, 27.2, 27.3, 17.1, 17.2, 15.1, 14.1, 17.3, 15.2, 17.4] +
+        range(40, 67),
+    'catholic': range(1, 17) + [16.1, 16.2, 17, 17.5, 17.1, 17.2, 18, 19,
+        20, 21, 22, 22.1, 22.2, 23, 24, 25, 25.1, 24.1, 26, 27, 27.1, 27.2,
+        27.3] + range(28, 40) + [14.1, 15.1, 15.2, 17.3, 17.4] +
+        range(40, 67),
+    'orthodox': range(1, 15) + [15.1, 15, 16, 16.1, 16.2, 17, 17.5, 17.1,
+        17.2, 17.3, 19, 14.1, 18, 20, 21, 22, 22.1, 22.2] + range(28, 40) +
+        [23, 24, 25.1, 25, 24.1, 26, 27, 27.1, 27.2, 27.3, 17.4, 15.2] +
+        range(40, 67),
+    }
+# canon -> {book number: rank}, ranks counting from 1 with no gaps, so a
+# book's place is one small integer
+canon_ranks = dict([(canon, dict([(number, rank) for rank, number
+    in enumerate(order, 1)])) for canon, order in canon_orders.items()])
+
+
+class FrozenBookDict(dict):
+    """
+    The book dictionary of a shared system, which can't be changed
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('shared book name systems can\'t be changed')
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _read_only
+
 
 class BookNameSystem():
     """
@@ -23,6 +112,23 @@ class BookNameSystem():
         self.book_dict = {}
         self.nbs = nbs
 
+    # set by freeze()
+    _frozen = False
+    _book_list = None
+
+    def __setattr__(self, name, value):
+        if self._frozen:
+            raise TypeError('shared book name systems can\'t be changed')
+        self.__dict__[name] = value
+
+    def freeze(self):
+        """
+        Make the system read-only and work out its book list once
+        """
+        self.book_dict = FrozenBookDict(self.book_dict)
+        self._book_list = tuple(self.book_list())
+        self._frozen = True
+
     def _alter_dict(self):
         """
         Update the main dictionary with the changes
@@ -39,10 +145,17 @@ class BookNameSystem():
             self.book_dict[key] = self.book_dict[key].replace(u'\u00a0',
                 self.nbs)
 
-    def book_list(self):
+    def book_list(self, canon=None):
         """
-        Return a list of the books in order
+        Return a list of the books in order: of their numbers, or of the
+        canon (see canon_orders)
         """
+        if canon is not None:
+            keys = sorted(self.book_dict.keys(),
+                key=canon_ranks[canon].__getitem__)
+            return [self.book_dict[key] for key in keys]
+        if self._book_list is not None:
+            return list(self._book_list)
         keys = sorted(self.book_dict.keys())
         return [self.book_dict[key] for key in keys]
 
@@ -567,16 +680,16 @@ class IVPAbbrDeuterocanon(THPBibleTeamAbbrDeuterocanon):
             54: u'Philem',
             15.1: u'1\u00a0Esdr',
             15.2: u'2\u00a0Esdr',
-            17.1: u'Add\u00a0Esther',
+            17.5: u'Add\u00a0Esther',
             24.1: u'Ep\u00a0Jer',
             27.1: u'Pr\u00a0Azar',
             27.2: u'Sus',
             27.3: u'Bel',
             14.1: u'Pr\u00a0Man',
-            17.2: u'1\u00a0Macc',
-            17.3: u'2\u00a0Macc',
-            17.4: u'3\u00a0Macc',
-            17.5: u'4\u00a0Macc',
+            17.1: u'1\u00a0Macc',
+            17.2: u'2\u00a0Macc',
+            17.3: u'3\u00a0Macc',
+            17.4: u'4\u00a0Macc',
         }
         self._alter_dict()
 
@@ -758,31 +871,120 @@ class THPXMLAbbr(THPBibleTeamAbbrDeuterocanon):
         self._alter_dict()
         
 
+_systems = {}
+_systems_lock = threading.Lock()
+
+def system_key(system_class, **options):
+    """
+    Return what the shared instance of a system with the given options is
+    kept under: (class, every option and its value, with options left out
+    as their defaults)
+    """
+    init = system_class.__init__.im_func
+    names = init.func_code.co_varnames[1:init.func_code.co_argcount]
+    values = dict(zip(names[len(names) - len(init.func_defaults or ()):],
+        init.func_defaults or ()))
+    values.update(options)
+    return (system_class, tuple(sorted(values.items())))
+
+def book_name_system(system_class, **options):
+    """
+    Return the shared, read-only instance of a system with the given
+    options (nbs, period). Every call with the same class and options gets
+    the same instance; options left out count as their defaults.
+    """
+    key = system_key(system_class, **options)
+    system = _systems.get(key)
+    if system is None:
+        with _systems_lock:
+            system = _systems.get(key)
+            if system is None:
+                system = system_class(**options)
+                system.freeze()
+                _systems[key] = system
+    return system
+
+# what binders made of shared systems derive from them, for any binder with
+# the same systems: (kind, systems) -> value
+_derived = {}
+
+
 class BookNameBinder():
     """
     Allows you to activate multiple BookNameSystems at once.
+    The name-to-number dictionary and the book name regex are built the first
+    time they're needed and then reused. If you change book_name_systems
+    after that, call reset().
+    Without book_name_systems, the default systems aren't made until
+    something asks for them.
+    Binders made only of shared systems (see book_name_system) share their
+    dictionary and regex too, so making another one costs next to nothing.
     """
     def __init__(self, book_name_systems=None):
-        if book_name_systems == None:
-            book_name_systems = [
-                    THPFullName(),
-                    THPFullName(nbs=u'\u00a0'),
-                    THPFullName(nbs=u'<nbs/>'),
-                    THPBibleTeamAbbr(),
-                    THPBibleTeamAbbr(nbs=u'\u00a0'),
-                    THPBibleTeamAbbr(nbs=u'<nbs/>'),
-                ]
-        self.book_name_systems = book_name_systems
+        if book_name_systems != None:
+            self.book_name_systems = book_name_systems
         # print self.book_name_systems
+        self.reset()
+
+    def __getattr__(self, name):
+        # only called for attributes the instance doesn't have yet
+        if name == 'book_name_systems':
+            self.book_name_systems = default_book_name_systems()
+            return self.book_name_systems
+        raise AttributeError(name)
+
+    def reset(self):
+        """
+        Forget the derived dictionary and regex
+        """
+        self._name_to_number = None
+        self._book_name_pattern = None
+        self._fingerprint = None
+        self._fuzzy_index = None
+
+    def fingerprint(self):
+        """
+        Return a hash of every name the binder recognizes and its number.
+        Two binders with the same fingerprint parse everything the same way.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = self._shared('fingerprint',
+                self._build_fingerprint)
+        return self._fingerprint
+
+    def _build_fingerprint(self):
+        import hashlib
+        items = sorted(self.book_name_to_number().items())
+        return hashlib.sha1(repr(items)).hexdigest()
+
+    def _shared(self, kind, build):
+        """
+        Return what build() returns, made once for every binder with the
+        same shared systems
+        """
+        systems = tuple(self.book_name_systems)
+        if not all([system._frozen for system in systems]):
+            return build()
+        key = (kind, systems)
+        value = _derived.get(key)
+        if value is None:
+            value = build()
+            _derived[key] = value
+        return value
 
     def book_list(self):
         """
         Return a list of the books in order
         """
+        return list(self._shared('book_list',
+            lambda: tuple(self._build_book_list())))
+
+    def _build_book_list(self):
         key_value_pairs = []
         for book_name_system in self.book_name_systems:
             key_value_pairs.extend(
-                [(key, value) for key, value in book_name_system.book_dict.iteritems()])
+                [(key, normalize_separators(value)) for key, value
+                    in book_name_system.book_dict.iteritems()])
         key_value_pairs = sorted(key_value_pairs)#, key=lambda kvp: kvp[0])
         b_list = []
         for kvp in key_value_pairs:
@@ -795,35 +997,86 @@ class BookNameBinder():
             b_list.append(u'Salmo')
         return b_list
 
+    def book_name_pattern(self):
+        """
+        Return a compiled regex that matches the lookup_key() of any of the
+        book names, trying the longest names first. Run it over the
+        lookup_key() of the text.
+        """
+        if self._book_name_pattern is None:
+            self._book_name_pattern = self._shared('pattern',
+                self._build_book_name_pattern)
+        return self._book_name_pattern
+
+    def _build_book_name_pattern(self):
+        b_list = []
+        for b in self.book_list():
+            if lookup_key(b) not in b_list:
+                b_list.append(lookup_key(b))
+        # escape periods
+        b_list = [b.replace(u'.', u'\.') for b in b_list]
+        b_list.sort(key=len, reverse=True)
+        return re.compile('|'.join(b_list))
+
     def book_name_to_number(self):
         """
-        Returns a dictionary with the book name options as keys and numbers as
-        values
+        Returns a dictionary with the lookup_key() of each book name option
+        as keys and numbers as values. Look names up with book_number() (or
+        lookup_key() them first).
         """
+        if self._name_to_number is None:
+            self._name_to_number = self._shared('name_to_number',
+                self._build_name_to_number)
+        return self._name_to_number
+
+    def _build_name_to_number(self):
         key_value_pairs = []
         for book_name_system in self.book_name_systems:
             key_value_pairs.extend(
                 [(key, value) for key, value in book_name_system.book_dict.iteritems()])
         key_value_pairs = sorted(key_value_pairs)#, key=lambda kvp: kvp[0])
-        name2number = {u'Psalm': 19, u'psalm': 19, u'PSALM': 19,
-                        u'Salmo': 19, u'salmo': 19, u'SALMO': 19,}
+        name2number = {u'psalm': 19, u'salmo': 19}
         for kvp in key_value_pairs:
-            if kvp[1] not in name2number:
-                name2number[kvp[1]] = kvp[0]
-            if kvp[1].upper() not in name2number:
-                name2number[kvp[1].upper()] = kvp[0]
-            if kvp[1].lower() not in name2number:
-                name2number[kvp[1].lower()] = kvp[0]
-            # if kvp[1].lower == u'psalms':
-            #     name2number[u'psalm'] = kvp[0]
-            #     name2number[u'PSALM'] = kvp[0]
-            #     name2number[u'Psalm'] = kvp[0]
-            # if kvp[1].lower == u'salmos':
-            #     name2number[u'salmo'] = kvp[0]
-            #     name2number[u'SALMO'] = kvp[0]
-            #     name2number[u'Salmo'] = kvp[0]
+            key = lookup_key(kvp[1])
+            if key not in name2number:
+                name2number[key] = kvp[0]
         return name2number
 
+    def fuzzy_index(self):
+        """
+        Return a bible_fuzzy.FuzzyIndex of the book_name_to_number() keys,
+        for finding names with typos in them
+        """
+        if self._fuzzy_index is None:
+            self._fuzzy_index = self._shared('fuzzy', self._build_fuzzy_index)
+        return self._fuzzy_index
+
+    def _build_fuzzy_index(self):
+        import bible_fuzzy
+        return bible_fuzzy.FuzzyIndex(self.book_name_to_number())
+
+    def book_number(self, book_name):
+        """
+        Return the number of a book name in any of its spellings, or None
+        """
+        if book_name is None:
+            return None
+        name2number = self.book_name_to_number()
+        # names from book_clean are already keys
+        number = name2number.get(book_name)
+        if number is None:
+            number = name2number.get(lookup_key(book_name))
+        return number
+
+def default_book_name_systems():
+    """
+    Return the systems a BookNameBinder uses if it isn't given any
+    """
+    return [
+        book_name_system(THPFullName),
+        book_name_system(THPBibleTeamAbbr),
+        ]
+
 def tester():
     # all_options = []
     systems = [
@@ -0,0 +1,122 @@
+#bible_cache.py
+"""
+Byte-budgeted LRU cache for passages.
+Popular passages get asked for over and over, so keep the rows that come back
+from the db and the xml that comes out of the transform.
+Entries are evicted least recently used first, whenever the total size of the
+cache goes over its byte budget (not when it has too many entries: one
+chapter of Psalms costs as much as a hundred single verses).
+
+usage:
+cache = ByteBudgetCache(max_bytes=1024 * 1024)
+cache.set(('xml', 'nlt', (43, 3, 16, 3, 16), ('paragraph.xsl',)), xml)
+xml = cache.get(('xml', 'nlt', (43, 3, 16, 3, 16), ('paragraph.xsl',)))
+print cache.stats()['hit_rate']
+"""
+import collections
+import threading
+
+
+def sizeof(value):
+    """
+    Estimate how many bytes a cached value holds on to.
+    Good enough for a budget: strings count their length, containers (lists
+    of rows, rows) count their contents plus a little overhead per item.
+    """
+    if value == None:
+        return 0
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (int, long, float)):
+        return 8
+    try:
+        items = value.keys()
+        items = [value[key] for key in items]
+    except (AttributeError, TypeError):
+        items = value
+    try:
+        return sum([sizeof(item) + 16 for item in items])
+    except TypeError:
+        return 64
+
+
+class ByteBudgetCache():
+    """
+    A thread-safe LRU cache that evicts by total size instead of entry count
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Return the cached value and mark it as most recently used
+        """
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=None):
+        """
+        Cache the value, evicting old entries until it fits in the budget.
+        Values bigger than the whole budget aren't cached at all.
+        """
+        if size == None:
+            size = sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                old_key, (old_value, old_size) = self._entries.popitem(
+                    last=False)
+                self.current_bytes -= old_size
+                self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """
+        Return a dictionary of hit/miss counts and how full the cache is
+        """
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        else:
+            hit_rate = 0.0
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': hit_rate,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            }
+
+
+# shared by every BibleCrossReference in the process
+passage_cache = ByteBudgetCache()
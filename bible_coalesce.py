@@ -0,0 +1,81 @@
+#bible_coalesce.py
+"""
+Let concurrent identical lookups share one computation.
+When lots of requests ask for the same thing at once (the verse of the day,
+say), the cache doesn't help until the first of them has finished, so they
+would all parse the reference, query the db and run the transform at the
+same time. A Coalescer runs the work for the first caller with a given key
+and makes the callers that arrive while it's running wait for that result
+(or that exception) instead.
+
+Only work that's in flight is shared; once it finishes, the next caller
+with the key runs it again (which is what the caches are for). Every waiter
+gets the same object back, so like cached values, don't change it.
+
+usage:
+coalescer = Coalescer('passages')
+passage = coalescer.do(cref.cache_key('rows'), cref.fetch_passage)
+"""
+import sys
+import threading
+
+import bible_metrics
+
+
+class Call():
+    """
+    One computation in flight, and what came of it
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class Coalescer():
+    """
+    Runs function(*args) once for all the callers that ask for a key at the
+    same time
+    """
+    def __init__(self, name):
+        # the label the shared calls are counted under in bible_metrics
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        """
+        Return function(*args), or the result of the call with the same key
+        that's already running. Raises whatever the call raised.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = Call()
+                self._calls[key] = call
+        if leader:
+            try:
+                call.result = function(*args)
+            except BaseException:
+                call.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            bible_metrics.coalesced.inc(self.name)
+            call.done.wait()
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+    def __len__(self):
+        """
+        The number of calls in flight
+        """
+        return len(self._calls)
+
+
+# shared by every BibleCrossReference in the process
+passage_coalescer = Coalescer('passage')
@@ -0,0 +1,224 @@
+#bible_db.py
+"""
+Maintenance tools for the verse database.
+Each version of the Bible lives in its own table (nlt, ntv, rvr, ...). The
+lookups in bible_parser filter on book_num, chapter_num and verse_num, and
+nothing in the db guarantees an index on those columns, so every lookup can
+turn into a scan of the whole Bible.
+
+usage:
+python bible_db.py                  # index, analyze and report every table
+python bible_db.py --report-only    # just show the query plans
+python bible_db.py --db other.db nlt ntv
+"""
+import contextlib
+import Queue
+import sqlite3
+import threading
+
+# the columns bible_parser filters on, plus what it reads back from the
+# start/end lookups. With Id as the rowid, this index covers those lookups.
+lookup_columns = ['book_num', 'chapter_num', 'verse_num', 'see']
+
+
+def connect(db_path=None):
+    """
+    Open the verse database with rows that can be addressed by column name
+    """
+    if db_path == None:
+        import bible_parser
+        db_path = bible_parser.db_path
+    connection = sqlite3.connect(db_path)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+
+class ConnectionPool():
+    """
+    Keeps connections to one db open so lookups don't pay for opening the
+    file every time. Connections can be handed from thread to thread, but
+    only one thread uses a connection at a time.
+    """
+    def __init__(self, db_path, max_idle=8):
+        self.db_path = db_path
+        self._idle = Queue.LifoQueue(max_idle)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            connection = sqlite3.connect(self.db_path,
+                check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            return connection
+
+    def release(self, connection):
+        try:
+            self._idle.put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        usage:
+        with pool.connection() as connection:
+            connection.execute(...)
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+# db path -> ConnectionPool
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_path):
+    """
+    Return the shared pool for the db, creating it on first use
+    """
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_path)
+            if pool is None:
+                pool = ConnectionPool(db_path)
+                _pools[db_path] = pool
+    return pool
+
+def table_columns(connection, table):
+    """
+    Return the PRAGMA table_info rows for the table
+    """
+    return connection.execute('PRAGMA table_info(%s)' % table).fetchall()
+
+def version_tables(connection):
+    """
+    Return the names of the tables that hold Bible versions, i.e., the tables
+    that have the columns bible_parser looks verses up by.
+    """
+    tables = connection.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+        "ORDER BY name").fetchall()
+    versions = []
+    for table in tables:
+        columns = [column['name'] for column in
+            table_columns(connection, table['name'])]
+        if 'book_num' in columns and 'chapter_num' in columns and \
+                'verse_num' in columns:
+            versions.append(table['name'])
+    return versions
+
+def id_is_rowid(connection, table):
+    """
+    Test whether Id is an INTEGER PRIMARY KEY. If it isn't, the index can't
+    cover the lookups, because sqlite has to go back to the table for Id.
+    """
+    for column in table_columns(connection, table):
+        if column['name'] == 'Id':
+            return column['pk'] == 1 and column['type'].upper() == 'INTEGER'
+    return False
+
+def index_name(table):
+    return '%s_lookup' % table
+
+def create_indexes(connection, table):
+    """
+    Create the covering index for the start/end verse lookups.
+    Columns that the table doesn't have are left out.
+    """
+    columns = [column['name'] for column in table_columns(connection, table)]
+    indexed = [column for column in lookup_columns if column in columns]
+    connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+        index_name(table), table, ', '.join(indexed)))
+    connection.commit()
+
+def analyze(connection, table=None):
+    """
+    Refresh the statistics the query planner uses to choose indexes
+    """
+    if table == None:
+        connection.execute('ANALYZE')
+    else:
+        connection.execute('ANALYZE %s' % table)
+    connection.commit()
+
+def lookup_queries(table):
+    """
+    Return (description, query, parameters) for each kind of lookup
+    bible_parser issues, with sample parameters for the query plan.
+    """
+    import bible_books
+    import bible_parser
+    cref = bible_parser.BibleCrossReference(table,
+        bible_books.BookNameBinder())
+    verse = cref.sql_params(u'Genesis', 1, 1)
+    last_verse = cref.sql_params(u'Genesis', 1, 'max')
+    return [
+        ('verse', verse[0], verse[1]),
+        ('last verse', last_verse[0], last_verse[1]),
+        ('redirect', cref.id_sql_params(1)[0], cref.id_sql_params(1)[1]),
+        ('passage', cref.range_sql_params(1, 31)[0],
+            cref.range_sql_params(1, 31)[1]),
+        ]
+
+def query_plans(connection, table):
+    """
+    Return (description, [plan details]) for each lookup
+    """
+    plans = []
+    for description, query, parameters in lookup_queries(table):
+        rows = connection.execute('EXPLAIN QUERY PLAN %s' % query,
+            parameters).fetchall()
+        plans.append((description, [row[-1] for row in rows]))
+    return plans
+
+def optimize(connection, tables=None, report_only=False, out=None):
+    """
+    Index and analyze each version table and write the query plans to out
+    """
+    if out == None:
+        import sys
+        out = sys.stdout
+    if tables == None:
+        tables = version_tables(connection)
+    for table in tables:
+        if not report_only:
+            create_indexes(connection, table)
+            analyze(connection, table)
+        out.write('%s\n%s\n' % (table, '=' * len(table)))
+        if not id_is_rowid(connection, table):
+            out.write('warning: Id is not an INTEGER PRIMARY KEY, '
+                'so lookups are not covered by %s\n' % index_name(table))
+        for description, details in query_plans(connection, table):
+            out.write('%s:\n' % description)
+            for detail in details:
+                out.write('    %s\n' % detail)
+        out.write('\n')
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description='Index and analyze the verse database.')
+    arg_parser.add_argument('tables', nargs='*',
+        help='version tables to optimize (default: all of them)')
+    arg_parser.add_argument('--db', default=None,
+        help='path to the database (default: bible_parser.db_path)')
+    arg_parser.add_argument('--report-only', action='store_true',
+        help="show the query plans without changing the database")
+    args = arg_parser.parse_args()
+    connection = connect(args.db)
+    optimize(connection, args.tables or None, args.report_only)
+    connection.close()
@@ -0,0 +1,198 @@
+#bible_executor.py
+"""
+Run passage lookups and transforms in the background.
+The db and xslt work in get_passage and xml() blocks, which an event loop
+can't afford. PassageExecutor runs that work on a thread pool (the same
+multiprocessing.pool.ThreadPool that bible_parser.version_pool uses; sqlite
+and libxslt both let other threads run while they work) and hands back a
+PassageFuture right away.
+
+A PassageFuture can be waited on with a timeout, cancelled while it's still
+waiting for a thread, or turned into a future of an asyncio (or trollius)
+event loop with to_loop_future, so it can be awaited.
+
+usage:
+future = cref.xml_async()
+xml = future.result(timeout=2)
+
+# in a coroutine
+xml = await bible_executor.to_loop_future(cref.xml_async(), loop)
+"""
+import sys
+import threading
+
+
+class Cancelled(Exception):
+    """
+    The work was cancelled before it started
+    """
+
+
+class Timeout(Exception):
+    """
+    The work didn't finish in time
+    """
+
+
+class PassageFuture():
+    """
+    The result of work submitted to a PassageExecutor
+    """
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._state = 'pending'
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def cancel(self):
+        """
+        Cancel the work if it hasn't started. Returns True if it's cancelled.
+        """
+        with self._lock:
+            if self._state == 'pending':
+                self._state = 'cancelled'
+            if self._state != 'cancelled':
+                return False
+        self._finish()
+        return True
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the work and return its result (or raise its exception)
+        """
+        if not self._done.wait(timeout):
+            raise Timeout()
+        if self._state == 'cancelled':
+            raise Cancelled()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the work and return the exception it raised, if any
+        """
+        if not self._done.wait(timeout):
+            raise Timeout()
+        if self._state == 'cancelled':
+            raise Cancelled()
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(future) when the work finishes or is cancelled.
+        The callback runs on the worker thread (or right away if it's done).
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _run(self):
+        with self._lock:
+            if self._state != 'pending':
+                return
+            self._state = 'running'
+        try:
+            self._result = self.function(*self.args)
+        except BaseException:
+            # anything at all, or result() would wait forever
+            self._exc_info = sys.exc_info()
+        finally:
+            self._state = 'finished'
+            self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class PassageExecutor():
+    """
+    A ThreadPool of max_workers threads that works through submitted
+    functions in order. The pool's own AsyncResult can't be cancelled or
+    called back from, so each function is wrapped in a PassageFuture.
+    """
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._pool = None
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def pool(self):
+        """
+        Return the thread pool, started once there's work for it
+        """
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    from multiprocessing.pool import ThreadPool
+                    self._pool = ThreadPool(self.max_workers)
+        return self._pool
+
+    def submit(self, function, *args):
+        """
+        Queue function(*args) and return a PassageFuture for it
+        """
+        if self._shutdown:
+            raise RuntimeError('executor has been shut down')
+        future = PassageFuture(function, args)
+        self.pool().apply_async(future._run)
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Let the queued work finish, then stop the threads
+        """
+        self._shutdown = True
+        if self._pool is not None:
+            self._pool.close()
+            if wait:
+                self._pool.join()
+
+
+def to_loop_future(future, loop):
+    """
+    Wrap a PassageFuture in a future of an asyncio or trollius event loop.
+    Cancelling the loop's future cancels the work if it hasn't started yet.
+    """
+    loop_future = loop.create_future()
+
+    def copy_state(future):
+        if loop_future.cancelled():
+            return
+        if future.cancelled():
+            loop_future.cancel()
+        elif future.exception() is not None:
+            loop_future.set_exception(future.exception())
+        else:
+            loop_future.set_result(future.result())
+
+    def on_loop_done(loop_future):
+        if loop_future.cancelled():
+            future.cancel()
+
+    loop_future.add_done_callback(on_loop_done)
+    future.add_done_callback(
+        lambda future: loop.call_soon_threadsafe(copy_state, future))
+    return loop_future
+
+
+# shared by every BibleCrossReference in the process
+passage_executor = PassageExecutor()
@@ -0,0 +1,160 @@
+#bible_fuzzy.py
+"""
+Find book names with typos in them (Genisis, Phillipians, 1Cor), the way
+scanned and hand-typed text has them.
+FuzzyIndex works out every way of deleting up to max_distance letters from
+each name ahead of time (symmetric delete). A name with a typo shares one
+of those with the name it was meant to be, so a lookup only deletes letters
+from what it's given and checks the few names that come up, instead of
+comparing it with every name.
+
+How far off a name can be depends on its length; short abbreviations
+(Jn, Gn, Ex) only match exactly, or anything would be one of them.
+
+usage:
+index = FuzzyIndex(binder.book_name_to_number())
+index.find(u'genisis')  # (1, u'genesis', 0.857...)
+
+python bible_fuzzy.py Genisis Phillipians 1Cor
+"""
+import re
+import threading
+
+# what the tokenizer leaves around a book name: a separator or 'and' before
+# it, and a period and space after it
+query_pattern = re.compile(ur'^(?: and | y |[;,] ?)?(.*?)[. ]*$')
+
+
+def distance(a, b):
+    """
+    The number of letters inserted, deleted, changed or swapped with the
+    next one to turn a into b (optimal string alignment)
+    """
+    if a == b:
+        return 0
+    previous2 = None
+    previous = range(len(b) + 1)
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and \
+                    a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[len(b)]
+
+def book_query(key):
+    """
+    Return the book name in the lookup_key() of a book token
+    """
+    return query_pattern.match(key).group(1)
+
+def allowed_distance(name):
+    """
+    How many typos a name of this length can have and still be matched
+    """
+    if len(name) < 4:
+        return 0
+    if len(name) < 7:
+        return 1
+    return 2
+
+def deletes(name, max_distance):
+    """
+    Return the set of everything made by deleting up to max_distance
+    letters from the name (including the name itself)
+    """
+    found = set([name])
+    edge = [name]
+    for i in range(max_distance):
+        following = []
+        for word in edge:
+            for j in range(len(word)):
+                shorter = word[:j] + word[j + 1:]
+                if shorter not in found:
+                    found.add(shorter)
+                    following.append(shorter)
+        edge = following
+    return found
+
+
+class FuzzyIndex():
+    """
+    Book names (lookup keys, see bible_books.lookup_key) that can be found
+    with a few typos in them
+    """
+    def __init__(self, name_to_number, max_distance=2, max_results=10000):
+        self.name_to_number = name_to_number
+        self.max_distance = max_distance
+        # each deletion -> the names it comes from
+        self.index = {}
+        for name in name_to_number:
+            for shorter in deletes(name, min(max_distance,
+                    allowed_distance(name))):
+                self.index.setdefault(shorter, []).append(name)
+        # what's been looked up before (the same typos tend to come back)
+        self.max_results = max_results
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def find(self, query):
+        """
+        Return (book number, name, confidence) for the name closest to the
+        query, or None if none are close enough. Confidence is 1 for an
+        exact match and goes down with every typo; it's split between the
+        books if different books are just as close.
+        """
+        if query in self._results:
+            return self._results[query]
+        result = self._find(query)
+        with self._lock:
+            if len(self._results) >= self.max_results:
+                self._results.clear()
+            self._results[query] = result
+        return result
+
+    def _find(self, query):
+        if query in self.name_to_number:
+            return (self.name_to_number[query], query, 1.0)
+        max_distance = min(self.max_distance, allowed_distance(query))
+        candidates = set()
+        for shorter in deletes(query, max_distance):
+            candidates.update(self.index.get(shorter, []))
+        best = None
+        books = set()
+        for name in candidates:
+            d = distance(query, name)
+            if d > max_distance or d > allowed_distance(name):
+                continue
+            rank = (d, abs(len(name) - len(query)),
+                self.name_to_number[name], name)
+            if best is None or rank[0] < best[0]:
+                books = set()
+            if best is None or rank < best:
+                best = rank
+            if d == best[0]:
+                books.add(self.name_to_number[name])
+        if best is None:
+            return None
+        d, length_difference, number, name = best
+        confidence = 1.0 - float(d) / max(len(query), len(name))
+        return (number, name, confidence / len(books))
+
+
+if __name__ == '__main__':
+    import sys
+    import bible_books
+    binder = bible_books.BookNameBinder()
+    index = binder.fuzzy_index()
+    names = binder.book_name_systems[0].book_dict
+    for query in sys.argv[1:]:
+        found = index.find(bible_books.lookup_key(query.decode('utf-8')))
+        if found is None:
+            print '%s: no match' % query
+        else:
+            print '%s: %s (%s, confidence %.2f)' % (query,
+                names[found[0]].encode('utf-8'),
+                found[1].encode('utf-8'), found[2])
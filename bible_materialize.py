@@ -0,0 +1,284 @@
+#bible_materialize.py
+"""
+Pre-rendered paragraph-oriented chapters.
+The transform from verse-oriented to paragraph-oriented xml is the slowest
+part of cref.xml(), and what it makes of a chapter never changes. So run it
+once for every chapter of a version and keep the result, along with where
+each verse starts in it. A passage can then be cut out of its chapters
+without any xslt at all.
+
+Where a cut falls inside a paragraph, the paragraph (and anything else open
+at that point) is reopened at the start of the slice and closed at the end,
+which is what add_starts_ends does for the verse-oriented xml. The
+<passage> around the slices, with its reference, goes through the same
+stylesheets, so whatever they make of those comes out as it does from xslt.
+
+usage:
+store = MaterializedStore(r'C:\\bibletext\\_paragraphs.db')
+store.build('nlt')
+bible_parser.BibleCrossReference.materialized = store
+cref.xml()  # now served from the store
+
+or from the command line:
+python bible_materialize.py C:\\bibletext\\_paragraphs.db nlt ntv rvr
+"""
+import json
+import re
+
+import bible_cache
+import bible_db
+import bible_parser
+import bible_versification
+
+# marks where each verse starts; the transform copies it through to the
+# paragraph-oriented xml
+verse_marker = '<?verse-id %d?>'
+marker_pattern = re.compile(r'<\?verse-id (\d+)\?>')
+# -start markers at the beginning of a verse belong before the verse marker,
+# so that the marker ends up inside the paragraph
+leading_starts_pattern = re.compile(r'^(\s*<[\w.:-]+-start(\s[^>]*)?/>)*')
+tag_pattern = re.compile(r'<[^>]*>')
+
+
+class MaterializeError(Exception):
+    """
+    The stylesheets didn't keep the verse markers, so the chapter
+    can't be sliced
+    """
+
+
+def mark_verses(passage):
+    """
+    Return the verse-oriented xml of a list of verses,
+    with a verse marker at the start of each one.
+    """
+    texts = []
+    for verse in passage:
+        text = verse['verse_text']
+        split = leading_starts_pattern.match(text).end()
+        texts.append('%s%s%s' % (text[:split], verse_marker % verse['Id'],
+            text[split:]))
+    return '\n'.join(texts)
+
+def index_verses(rendered):
+    """
+    Take the paragraph-oriented xml of a chapter (with verse markers) and
+    return (xml without the markers, verses), where verses is a list of
+    [verse Id, offset, [tags open at the offset]]. The tags don't include
+    the root element.
+    """
+    pieces = []
+    verses = []
+    stack = []
+    position = 0
+    length = 0
+    for m in tag_pattern.finditer(rendered):
+        tag = m.group()
+        marker = marker_pattern.match(tag)
+        if marker:
+            pieces.append(rendered[position:m.start()])
+            length += m.start() - position
+            position = m.end()
+            verses.append([int(marker.group(1)), length, stack[1:]])
+        elif tag.startswith('<?') or tag.startswith('<!'):
+            continue
+        elif tag.startswith('</'):
+            stack.pop()
+        elif not tag.endswith('/>'):
+            stack.append(tag)
+    pieces.append(rendered[position:])
+    return ''.join(pieces), verses
+
+def close_tags(open_tags):
+    """
+    Return the end tags for a list of open tags, innermost first
+    """
+    names = [tag[1:-1].split()[0] for tag in open_tags]
+    names.reverse()
+    return ''.join(['</%s>' % name for name in names])
+
+
+class MaterializedStore():
+    """
+    A sqlite db of pre-rendered chapters, one set per version and list of
+    stylesheets
+    """
+    def __init__(self, path, max_bytes=16 * 1024 * 1024):
+        self.path = path
+        self.pool = bible_db.ConnectionPool(path)
+        # recently sliced chapters
+        self.chapters = bible_cache.ByteBudgetCache(max_bytes)
+        with self.pool.connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS chapters ('
+                'version TEXT, stylesheets TEXT, '
+                'book_num INTEGER, chapter_num INTEGER, '
+                'xml TEXT, verses TEXT, '
+                'PRIMARY KEY (version, stylesheets, book_num, chapter_num))')
+            connection.commit()
+
+    def render_chapter(self, passage, included_stylesheets):
+        """
+        Transform one chapter's verses and index where each verse starts
+        """
+        from lxml import etree
+        cref = bible_parser.BibleCrossReference(None, None)
+        passage_xml = cref.add_starts_ends(mark_verses(passage),
+            passage[0]['class_context'])
+        stylesheet = bible_parser.compiled_stylesheet(included_stylesheets)
+        rendered = etree.tostring(
+            stylesheet(etree.XML('<passage>\n%s</passage>' % passage_xml)),
+            encoding=unicode)
+        chapter_xml, verses = index_verses(rendered)
+        if len(verses) != len(passage):
+            raise MaterializeError('%d of %d verse markers survived' % (
+                len(verses), len(passage)))
+        return chapter_xml, verses
+
+    def build(self, version, included_stylesheets=['paragraph.xsl'],
+            out=None):
+        """
+        Render every chapter of the version into the store.
+        Chapters that can't be indexed are reported and left out; passages
+        in them are transformed at request time as usual.
+        """
+        stylesheets = '|'.join(included_stylesheets)
+        with bible_db.get_pool(bible_parser.db_path).connection() as source:
+            versification = bible_versification.build(version, source)
+            with self.pool.connection() as connection:
+                for book_num in sorted(versification.chapter_lengths):
+                    for chapter_num in range(1,
+                            versification.chapter_count(book_num) + 1):
+                        passage = source.execute(
+                            'SELECT * FROM %s '
+                            'WHERE book_num = ? AND chapter_num = ? '
+                            'ORDER BY Id' % version,
+                            (book_num, chapter_num)).fetchall()
+                        if not passage:
+                            continue
+                        try:
+                            chapter_xml, verses = self.render_chapter(passage,
+                                included_stylesheets)
+                        except MaterializeError as X:
+                            if out is not None:
+                                out.write('%s %d:%d: %s\n' % (version,
+                                    book_num, chapter_num, X))
+                            continue
+                        connection.execute(
+                            'INSERT OR REPLACE INTO chapters '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (version.lower(), stylesheets, book_num,
+                                chapter_num, chapter_xml, json.dumps(verses)))
+                connection.commit()
+        self.chapters.clear()
+
+    def chapter(self, version, included_stylesheets, book_num, chapter_num):
+        """
+        Return (xml, verses) for a chapter, or None if it isn't in the store
+        """
+        key = (version.lower(), tuple(included_stylesheets), book_num,
+            chapter_num)
+        chapter = self.chapters.get(key)
+        if chapter is None:
+            with self.pool.connection() as connection:
+                row = connection.execute(
+                    'SELECT xml, verses FROM chapters '
+                    'WHERE version = ? AND stylesheets = ? '
+                    'AND book_num = ? AND chapter_num = ?',
+                    (version.lower(), '|'.join(included_stylesheets),
+                        book_num, chapter_num)).fetchone()
+            if row is None:
+                return None
+            chapter = (row['xml'], json.loads(row['verses']))
+            self.chapters.set(key, chapter)
+        return chapter
+
+    def slice_chapter(self, chapter, first_id=None, last_id=None):
+        """
+        Cut the verses from first_id to last_id (default: the whole chapter)
+        out of a chapter and balance the tags at either end.
+        """
+        chapter_xml, verses = chapter
+        ids = [verse[0] for verse in verses]
+        if first_id is None:
+            first = 0
+        else:
+            first = ids.index(first_id)
+        start, open_tags = verses[first][1], verses[first][2]
+        if last_id is None or ids.index(last_id) == len(verses) - 1:
+            # up to the end tag of the root
+            end, end_tags = chapter_xml.rfind('</'), []
+        else:
+            following = verses[ids.index(last_id) + 1]
+            end, end_tags = following[1], list(following[2])
+        piece = chapter_xml[start:end]
+        if end_tags:
+            # the newline that joined the last verse to the next one
+            if piece.endswith('\n'):
+                piece = piece[:-1]
+            # an element that only opens right before the cut (like the
+            # next paragraph, when a verse ends with its -start) comes out
+            # empty, the way the xslt gives it
+            if piece.endswith(end_tags[-1]):
+                piece = '%s/>' % piece[:-1]
+                end_tags.pop()
+        opening = ''.join(open_tags)
+        if open_tags and not chapter_xml[:start].endswith(open_tags[-1]):
+            # reopened in the middle, like the -start from add_starts_ends
+            opening += '\n'
+        return opening + piece + close_tags(end_tags)
+
+    def wrapper(self, cref, included_stylesheets):
+        """
+        Transform a <passage> with the cref's reference and no verses, and
+        return (everything before where the verses go, the end tag), so
+        the wrapper and the reference come out the way the stylesheets
+        make them
+        """
+        from lxml import etree
+        stylesheet = bible_parser.compiled_stylesheet(included_stylesheets)
+        rendered = etree.tostring(
+            stylesheet(etree.XML(cref.passage_document(''))),
+            encoding=unicode)
+        if rendered.endswith(u'/>'):
+            # nothing in it, so it was written as an empty element
+            name = rendered[1:-2].split()[0]
+            return u'%s>' % rendered[:-2].rstrip(), u'</%s>' % name
+        end = rendered.rfind(u'</')
+        return rendered[:end], rendered[end:]
+
+    def passage_xml(self, cref, included_stylesheets=['paragraph.xsl']):
+        """
+        Return the paragraph-oriented xml for a cross-reference,
+        or None if one of its chapters isn't in the store.
+        """
+        with bible_db.get_pool(bible_parser.db_path).connection() as \
+                connection:
+            cursor = connection.cursor()
+            cref.check_chapters(cursor)
+            start = cref.get_start_verse(cursor)
+            end = cref.get_end_verse(cursor)
+        if int(start['Id']) > int(end['Id']):
+            raise bible_parser.VerseError(cref.original)
+        pieces = []
+        for chapter_num in range(start['chapter_num'],
+                end['chapter_num'] + 1):
+            chapter = self.chapter(cref.bible_version, included_stylesheets,
+                start['book_num'], chapter_num)
+            if chapter is None:
+                return None
+            first_id = last_id = None
+            if chapter_num == start['chapter_num']:
+                first_id = start['Id']
+            if chapter_num == end['chapter_num']:
+                last_id = end['Id']
+            pieces.append(self.slice_chapter(chapter, first_id, last_id))
+        head, tail = self.wrapper(cref, included_stylesheets)
+        return (head + u''.join(pieces) + tail).encode('utf-8')
+
+
+if __name__ == '__main__':
+    import sys
+    store = MaterializedStore(sys.argv[1])
+    for version in sys.argv[2:]:
+        store.build(version, out=sys.stdout)
@@ -0,0 +1,133 @@
+#bible_metrics.py
+"""
+Timing histograms and counters for the reference service, in the Prometheus
+text format.
+Recording a value is a lock and a few additions, cheap enough to leave on
+in production. Set enabled = False to turn it off.
+
+The stages (tokenize, parse, book_clean, book_fuzzy, book_number,
+pretty_cref) nest: parse calls book_clean, which calls book_fuzzy for names
+it doesn't know, and pretty_cref calls book_number. Each is timed on its
+own.
+
+Every process keeps its own numbers, so with several workers each /metrics
+response covers the worker that answered it.
+
+usage:
+started = time.time()
+...
+bible_metrics.stage_seconds.observe('parse', time.time() - started)
+bible_metrics.errors.inc('VerseError')
+print bible_metrics.render()
+"""
+import bisect
+import threading
+
+enabled = True
+
+# upper bounds in seconds, from 10 microseconds to a second
+default_buckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def escape_label(value):
+    return unicode(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"'
+        ).replace(u'\n', u'\\n').encode('utf-8')
+
+
+class Counter():
+    """
+    Counts, broken down by one label
+    """
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        if not enabled:
+            return
+        with self._lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s counter' % self.name]
+        for label_value, value in sorted(self.values.items()):
+            lines.append('%s{%s="%s"} %s' % (self.name, self.label,
+                escape_label(label_value), format_value(value)))
+        return '\n'.join(lines)
+
+
+class Histogram():
+    """
+    Durations sorted into buckets, broken down by one label
+    """
+    def __init__(self, name, help, label, buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # label value -> [counts per bucket (+ one for the rest), sum]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        if not enabled:
+            return
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            value = self.values.get(label_value)
+            if value is None:
+                value = [[0] * (len(self.buckets) + 1), 0.0]
+                self.values[label_value] = value
+            value[0][i] += 1
+            value[1] += seconds
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s histogram' % self.name]
+        for label_value, (counts, total) in sorted(self.values.items()):
+            label = '%s="%s"' % (self.label, escape_label(label_value))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label,
+                    format_value(bound), cumulative))
+            cumulative += counts[-1]
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, label,
+                cumulative))
+            lines.append('%s_sum{%s} %s' % (self.name, label,
+                format_value(total)))
+            lines.append('%s_count{%s} %d' % (self.name, label, cumulative))
+        return '\n'.join(lines)
+
+
+stage_seconds = Histogram('bibleref_stage_seconds',
+    'Time spent in each stage of handling a reference', 'stage')
+requests = Counter('bibleref_requests_total',
+    'Requests handled, by endpoint', 'endpoint')
+tokens = Counter('bibleref_tokens_total',
+    'Tokens found in reference strings, by type', 'type')
+cache = Counter('bibleref_cache_total',
+    'Response cache lookups, by result', 'result')
+errors = Counter('bibleref_errors_total',
+    'Errors, by exception type', 'type')
+coalesced = Counter('bibleref_coalesced_total',
+    'Lookups that waited for an identical one already in flight, by kind',
+    'kind')
+
+metrics = [stage_seconds, requests, tokens, cache, errors, coalesced]
+
+def render():
+    """
+    Return every metric in the Prometheus text format
+    """
+    return '\n'.join([metric.render() for metric in metrics]) + '\n'
@@ -0,0 +1,177 @@
+#bible_paragraphs.py
+"""
+Turn verse-oriented xml into paragraph-oriented xml without xslt.
+In the db, paragraphs (and other blocks) don't nest neatly inside verses,
+so each verse marks where they begin and end with empty elements:
+<paragraph-start class="body"/> ... <paragraph-end/>
+The default paragraph.xsl turns each pair of markers into one element:
+<paragraph class="body"> ... </paragraph>
+and that is all assemble() does, in one pass over the text, so it can work
+on a passage as it streams out of the db.
+
+Whitespace between blocks is dropped, the way the stylesheet drops it.
+Everything else is passed through as it is.
+
+cref.xml() only uses it with BibleCrossReference.native_paragraphs set.
+That's off by default, since the production stylesheets aren't in this
+tree and assemble() has only been compared with a stand-in; run this
+module against the real xsl directory before turning it on.
+
+usage:
+xml = ''.join(assemble(cref.iter_passage_document()))
+bible_parser.BibleCrossReference.native_paragraphs = True
+
+python bible_paragraphs.py [corpus.txt]
+checks assemble() against the xslt for each reference in the corpus
+(one reference per line; default: fixture_corpus)
+"""
+import re
+
+tag_pattern = re.compile(r'<[^>]*>')
+start_pattern = re.compile(r'<([\w.:]+(?:-[\w.:]+)*)-start(\s[^>]*?)?\s*/>$')
+end_pattern = re.compile(r'<([\w.:]+(?:-[\w.:]+)*)-end\s*/>$')
+
+# references to check the assembler against the stylesheet with: verses at
+# the start, middle and end of paragraphs, whole chapters, chapter ranges,
+# and passages that cross chapters
+fixture_corpus = [
+    u'Genesis 1:1',
+    u'Genesis 1:6-8',
+    u'Genesis 1:7',
+    u'Genesis 1:31-2:3',
+    u'Genesis 1\u20133',
+    u'Psalm 23',
+    u'Psalm 119:105-112',
+    u'Psalm 119',
+    u'John 3:16',
+    u'John 3:16-21',
+    u'Revelation 22',
+    ]
+
+
+def assemble(pieces):
+    """
+    Take the pieces of a verse-oriented <passage> document (in any number
+    of pieces, split anywhere) and yield the paragraph-oriented document.
+    """
+    # real elements that are open, and blocks that have been started
+    depth = 0
+    blocks = []
+    # a block start tag that hasn't been written yet, so that an empty block
+    # can come out as <paragraph class="body"/> like it does from the xslt
+    pending = None
+    held = ''
+    for piece in pieces:
+        text = held + piece
+        # hold back a tag that's been split between pieces
+        cut = text.rfind('<')
+        if cut != -1 and text.find('>', cut) == -1:
+            text, held = text[:cut], text[cut:]
+        else:
+            held = ''
+        position = 0
+        for m in tag_pattern.finditer(text):
+            between = text[position:m.start()]
+            position = m.end()
+            tag = m.group()
+            if between:
+                if blocks or depth > 1 or between.strip():
+                    if pending is not None:
+                        yield pending
+                        pending = None
+                    yield between
+            start = start_pattern.match(tag)
+            end = end_pattern.match(tag)
+            if start:
+                if pending is not None:
+                    yield pending
+                blocks.append(start.group(1))
+                pending = '<%s%s>' % (start.group(1), start.group(2) or '')
+            elif end:
+                if end.group(1) not in blocks:
+                    # an -end without a -start: nothing to close
+                    continue
+                while blocks:
+                    name = blocks.pop()
+                    if pending is not None:
+                        yield pending[:-1] + '/>'
+                        pending = None
+                    else:
+                        yield '</%s>' % name
+                    if name == end.group(1):
+                        break
+            else:
+                if tag.startswith('</'):
+                    depth -= 1
+                    if depth == 0:
+                        # the end of the passage closes any open blocks
+                        while blocks:
+                            name = blocks.pop()
+                            if pending is not None:
+                                yield pending[:-1] + '/>'
+                                pending = None
+                            else:
+                                yield '</%s>' % name
+                elif not tag.endswith('/>') and not tag.startswith('<?') \
+                        and not tag.startswith('<!'):
+                    depth += 1
+                if pending is not None:
+                    yield pending
+                    pending = None
+                yield tag
+        rest = text[position:]
+        if rest and (blocks or depth > 1 or rest.strip()):
+            if pending is not None:
+                yield pending
+                pending = None
+            yield rest
+    if held:
+        yield held
+
+def canonical(xml_text):
+    """
+    Return the xml in canonical form, so two documents can be compared
+    without worrying about how they were serialized
+    """
+    from lxml import etree
+    if isinstance(xml_text, unicode):
+        xml_text = xml_text.encode('utf-8')
+    return etree.tostring(etree.XML(xml_text), method='c14n')
+
+def compare_to_xslt(crefs, included_stylesheets=['paragraph.xsl']):
+    """
+    Render each cross-reference both ways and return
+    [(pretty_cref, assembled, transformed)] for the ones that differ
+    """
+    differences = []
+    for cref in crefs:
+        verse_xml = cref.verse_xml()
+        assembled = ''.join(assemble([cref.passage_document(verse_xml)]))
+        transformed = cref.orient_to_paragraph(verse_xml,
+            included_stylesheets)
+        if canonical(assembled) != canonical(transformed):
+            differences.append((cref.pretty_cref(), assembled, transformed))
+    return differences
+
+
+if __name__ == '__main__':
+    import codecs
+    import sys
+    import bible_parser
+    if len(sys.argv) > 1:
+        fl = codecs.open(sys.argv[1], 'r', encoding='utf-8')
+        corpus = [line.strip() for line in fl if line.strip()]
+        fl.close()
+    else:
+        corpus = fixture_corpus
+    crp = bible_parser.CrossReferenceParser()
+    crefs = []
+    for line in corpus:
+        crefs.extend([cref for cref in crp.parse(crp.tokenize(line))
+            if cref.ignore == False])
+    differences = compare_to_xslt(crefs)
+    for pretty, assembled, transformed in differences:
+        print pretty.encode('utf-8')
+        print '  assembled:   %s' % assembled.encode('utf-8')
+        print '  transformed: %s' % transformed
+    print '%d of %d passages differ' % (len(differences), len(crefs))
@@ -9,15 +9,140 @@ Also need to test half verses.
 Half verses should be tokenized properly, but they're not added to pretty_cref.
 Should they be?
 """
+import copy
+import itertools
+import os
 import re
+import threading
+import time
 # import bible_passages
 import bible_books
-import bible_regex
+import bible_cache
+import bible_coalesce
+import bible_metrics
 # import sqlite3
 # import complib.xslt
-import StringIO
+# Everything else (json, lxml, bible_db, bible_executor, bible_paragraphs,
+# bible_versification) is imported where it's used, so that parsing a
+# reference from the command line or a plugin doesn't wait for it.
 
 db_path = r'C:\bibletext\_bible.db'
+# what the start/end verse lookups read back. bible_db indexes exactly these
+# columns, so the lookups never have to touch the table itself.
+lookup_columns = 'Id, book_num, chapter_num, verse_num, see'
+
+# threads for looking up several versions at once (see get_passage_versions)
+version_threads = 8
+_version_pool = None
+_version_pool_lock = threading.Lock()
+
+def version_pool():
+    """
+    Return the thread pool shared by every multi-version lookup
+    """
+    global _version_pool
+    if _version_pool is None:
+        with _version_pool_lock:
+            if _version_pool is None:
+                from multiprocessing.pool import ThreadPool
+                _version_pool = ThreadPool(version_threads)
+    return _version_pool
+
+markup_pattern = re.compile(r'<[^>]*>')
+# elements whose content isn't part of the verse's text: the verse number
+# (text() and passage_dict() give it separately) and notes
+skipped_pattern = re.compile(
+    r'<(verse-number|note)\b[^>]*?(?:/>|>.*?</\1\s*>)', re.DOTALL)
+space_pattern = re.compile(r'<nbs\s*/>')
+entity_pattern = re.compile(r'&(#x[0-9A-Fa-f]+|#\d+|amp|lt|gt|quot|apos);')
+named_entities = {'amp': u'&', 'lt': u'<', 'gt': u'>', 'quot': u'"',
+    'apos': u"'"}
+
+def plain_text(verse_text):
+    """
+    Strip the markup out of a verse and resolve its character references.
+    The verse number and notes go with their tags; <nbs/> becomes a space.
+    """
+    def resolve(m):
+        entity = m.group(1)
+        if entity.startswith('#x'):
+            return unichr(int(entity[2:], 16))
+        if entity.startswith('#'):
+            return unichr(int(entity[1:]))
+        return named_entities[entity]
+    text = skipped_pattern.sub(u'', verse_text)
+    text = space_pattern.sub(u' ', text)
+    text = markup_pattern.sub(u'', text)
+    text = entity_pattern.sub(resolve, text)
+    return u' '.join(text.split())
+
+def serialize_nodes(nodes):
+    """
+    Return transformed xml the way cref.xml() gives it: the top-level nodes
+    of the result, one after another, in utf-8
+    """
+    from lxml import etree
+    return ''.join([etree.tostring(node, method='xml', encoding='utf-8',
+        with_tail=False) for node in nodes])
+
+def canonical_id(book_num, chapter_num, verse_num):
+    """
+    Number a verse for sorting and linking: Gen 1:1 = 1001001,
+    John 3:16 = 43003016
+    """
+    return int(book_num) * 1000000 + int(chapter_num) * 1000 + int(verse_num)
+
+def sort_key_function(canon='protestant'):
+    """
+    Return a key function for sorting BibleCrossReferences in the order of
+    a canon (see BibleCrossReference.sort_key):
+    crefs.sort(key=sort_key_function('catholic'))
+    """
+    return lambda cref: cref.sort_key(canon)
+
+# copy_all.xsl and the stylesheets it includes live here
+xsl_dir = r'xsl'
+# tuple of included stylesheets -> compiled XSLT
+_stylesheets = {}
+_stylesheets_lock = threading.Lock()
+
+def compose_stylesheet(included_stylesheets):
+    """
+    Return the text of copy_all.xsl with an xsl:include for each of the
+    included stylesheets spliced in before its first template.
+    """
+    fl = open(os.path.join(xsl_dir, 'copy_all.xsl'), 'r')
+    stylesheet = fl.read()
+    fl.close()
+    includes = '\n'.join(
+        ['<xsl:include href="%s"/>' % ss for ss in included_stylesheets])
+    stylesheet = stylesheet.replace('<xsl:template ',
+        '%s\n<xsl:template ' % includes,
+        1)
+    return stylesheet
+
+def compiled_stylesheet(included_stylesheets):
+    """
+    Return the compiled XSLT for a list of included stylesheets.
+    Each distinct list is composed in memory and compiled only once; the
+    compiled XSLT can be called from several threads at the same time.
+    """
+    key = tuple(included_stylesheets)
+    stylesheet = _stylesheets.get(key)
+    if stylesheet is None:
+        with _stylesheets_lock:
+            stylesheet = _stylesheets.get(key)
+            if stylesheet is None:
+                from lxml import etree
+                # the base url makes the includes resolve the same way they
+                # would from a main.xsl sitting next to copy_all.xsl
+                base_url = os.path.join(os.path.abspath(xsl_dir), 'main.xsl')
+                stylesheet = etree.XSLT(etree.XML(
+                    compose_stylesheet(included_stylesheets),
+                    base_url=base_url))
+                _stylesheets[key] = stylesheet
+    return stylesheet
+
 
 class CrossReferenceParser():
     """
@@ -54,7 +179,8 @@ class CrossReferenceParser():
             self.and_pattern = re.compile(
                 ur'([;,])?( y )')
             self.book_pattern = re.compile(
-                ur'( y |[;,] ?)?([1-3]( |<nbs/>|\u00a0)?)?([A-Za-z\u00c1\u00c9\u00cd\u00d3\u00da\u00e1\u00e9\u00ed\u00f3\u00fa]{2,})( )(de los Cantares )?')
+                ur'( y |[;,] ?)?([1-3](%(s)s)?)?([A-Za-z\u00c1\u00c9\u00cd\u00d3\u00da\u00e1\u00e9\u00ed\u00f3\u00fa]{2,})(%(s)s)(de%(s)slos%(s)sCantares%(s)s)?' % {
+                    's': bible_books.separator})
             self.ch_or_vs_pattern = re.compile(
                 ur'( y |[-\u2013\u2014]|[;,] ?)?(\d{1,3})(:)?')
             self.half_verse_pattern = re.compile(
@@ -67,7 +193,8 @@ class CrossReferenceParser():
             self.and_pattern = re.compile(
                 ur'([;,])?( and )')
             self.book_pattern = re.compile(
-                ur'( and |[;,] ?)?([1-3]( |<nbs/>|\u00a0)?)?([A-Za-z]{2,})\.?( )(of (Songs|Solomon) )?')
+                ur'( and |[;,] ?)?([1-3](%(s)s)?)?([A-Za-z\u00c1\u00c9\u00cd\u00d3\u00da\u00e1\u00e9\u00ed\u00f3\u00fa]{2,})\.?(%(s)s)(of%(s)s(Songs|Solomon)%(s)s)?' % {
+                    's': bible_books.separator})
             self.ch_or_vs_pattern = re.compile(
                 ur'( and |[-\u2013\u2014]|[;,] ?)?(\d{1,3})(:)?')
             self.half_verse_pattern = re.compile(
@@ -80,14 +207,18 @@ class CrossReferenceParser():
     def tokenize(self, reference_string):
         """
         Imitating dalkescientific.com/writings/NBN/parsing_by_hand.html
+        The patterns run over a copy with all spaces made plain, but the
+        tokens are the text of the reference_string itself.
         """
+        original = reference_string
+        reference_string = bible_books.normalize_spaces(reference_string)
         N = len(reference_string)
         pos = 0
         active_colon = False
         while pos < N:
             m = self.and_pattern.match(reference_string, pos)
             if m:
-                yield ("and", pos, m.group())
+                yield ("and", pos, original[pos:m.end()])
                 # if DEBUG:
                 # print 'yielded %s as "and"' % m.group().encode('utf-8')
                 pos = m.end()
@@ -95,7 +226,7 @@ class CrossReferenceParser():
             m = self.book_pattern.match(reference_string, pos)
             # print reference_string.encode('utf-8')
             if m:
-                yield ("book", pos, m.group())
+                yield ("book", pos, original[pos:m.end()])
                 # if 'Cantar' in reference_string:
                 # print 'yielded %s as "book"' % m.group().encode('utf-8')
                 pos = m.end()
@@ -104,13 +235,13 @@ class CrossReferenceParser():
             m = self.ch_or_vs_pattern.match(reference_string, pos)
             if m:
                 if active_colon and ':' not in m.group():
-                    yield ("verse", pos, m.group())
+                    yield ("verse", pos, original[pos:m.end()])
                     # if DEBUG:
                     # print 'yielded %s as "verse"' % m.group().encode('utf-8')
                     pos = m.end()
                     continue
                 else:
-                    yield ("chapter", pos, m.group())
+                    yield ("chapter", pos, original[pos:m.end()])
                     # if DEBUG:
                     # print 'yielded %s as "chapter"' % m.group().encode('utf-8')
                     pos = m.end()
@@ -119,27 +250,27 @@ class CrossReferenceParser():
                     continue
             m = self.f_pattern.match(reference_string, pos)
             if m:
-                yield ("verse", pos, m.group())
+                yield ("verse", pos, original[pos:m.end()])
                 # if DEBUG:
                 # print 'yielded %s as "verse"' % m.group().encode('utf-8')
                 pos = m.end()
                 continue
             m = self.half_verse_pattern.match(reference_string, pos)
             if m:
-                yield ("half-verse", pos, m.group())
+                yield ("half-verse", pos, original[pos:m.end()])
                 # if DEBUG:
                 # print 'yielded %s as "half-verse"' % m.group().encode('utf-8')
                 pos = m.end()
                 continue
             m = self.f_pattern.match(reference_string, pos)
             if m:
-                yield ("half-verse", pos, m.group())
+                yield ("half-verse", pos, original[pos:m.end()])
                 # if DEBUG:
                 # print 'yielded %s as "half-verse"' % m.group().encode('utf-8')
                 pos = m.end()
                 continue
             raise TypeError('Unknown text at position %d (%r)' %
-                (pos, reference_string))
+                (pos, original))
 
     def new_passage(self, token_type, token):
         """
@@ -148,6 +279,7 @@ class CrossReferenceParser():
         if token_type == 'book':# or token_type == 'and':
             return True
         separators = [',', ';', ' and ', ' y ', ' e ']
+        token = bible_books.normalize_spaces(token)
         for sep in separators:
             if sep in token:
                 return True
@@ -193,11 +325,67 @@ class CrossReferenceParser():
                 cref.glue(token_type, token)
         yield cref
 
+    def parse_many(self, reference_strings):
+        """
+        Parse a list of reference strings.
+        Yield (reference_string, [crefs], error) for each one, in order.
+        A string that can't be parsed or resolved gets an empty list and the
+        exception instead of stopping the batch. "and" crefs are left out.
+        Repeated strings are only parsed once.
+        """
+        done = {}
+        for reference_string in reference_strings:
+            if reference_string not in done:
+                try:
+                    try:
+                        crefs = list(self.parse(self.tokenize(
+                            reference_string)))
+                    except AttributeError:
+                        # a verse or half-verse with no cref started to
+                        # glue it on to ("John", "f")
+                        raise VerseError(reference_string)
+                    if None in crefs:
+                        # nothing at all to make a cref of ("")
+                        raise VerseError(reference_string)
+                    crefs = [cref for cref in crefs if cref.ignore == False]
+                    # resolve the book names now, so errors turn up here
+                    for cref in crefs:
+                        cref.book_number(cref.book)
+                    done[reference_string] = (crefs, None)
+                except (TypeError, VerseError) as X:
+                    done[reference_string] = ([], X)
+            crefs, error = done[reference_string]
+            yield reference_string, crefs, error
+
 
 class BibleCrossReference():
     """
     An object that stores the crucial data about a cross-reference
     """
+    # passage rows and rendered xml, shared across instances.
+    # Set to None to always go to the db.
+    cache = bible_cache.passage_cache
+    # concurrent lookups of the same passage share one db query and one
+    # transform. Set to None to have each do its own.
+    coalescer = bible_coalesce.passage_coalescer
+    # the kinds of cached values that have pretty_cref() in them
+    rendered_kinds = ('xml',)
+    # a bible_materialize.MaterializedStore of pre-rendered chapters to cut
+    # passages from instead of transforming them
+    materialized = None
+    # use bible_paragraphs instead of the xslt when the only stylesheet is
+    # the default paragraph.xsl. Off by default: the production
+    # stylesheets (xsl_dir) aren't part of this tree, so assemble() has
+    # only been compared with a stand-in paragraph.xsl (the one in
+    # tests/verses.py). Anything else the real one does would be silently
+    # lost. Turn it on where `python bible_paragraphs.py` finds no
+    # differences against the real xsl directory and db.
+    native_paragraphs = False
+    # the lowest confidence a misspelled book name (see bible_fuzzy) is
+    # taken at, e.g. 0.7. None (the default) doesn't look for misspelled
+    # names at all.
+    fuzzy_confidence = None
+
     def __init__(self, bible_version, book_name_binder):
         self.bible_version = bible_version
         self.book_name_binder = book_name_binder# a bible_books.BookNameBinder object
@@ -208,6 +396,8 @@ class BibleCrossReference():
         self.verse_last = None
         self.original = ''
         self.ignore = False
+        # 1.0 unless the book name had to be guessed at
+        self.book_confidence = 1.0
 
     def glue(self, token_type, token, carryover=False):
         """
@@ -253,6 +443,65 @@ class BibleCrossReference():
         pretty += pretty_chap
         return pretty
 
+    def reference_dict(self):
+        """
+        Return the parsed reference as plain data (numbers are ints, and
+        missing verses are None)
+        """
+        def number(value):
+            if value:
+                return int(value)
+            return None
+        return {
+            'book_number': self.book_number(self.book),
+            'chapter_first': number(self.chapter_first),
+            'chapter_last': number(self.chapter_last),
+            'verse_first': number(self.verse_first),
+            'verse_last': number(self.verse_last),
+            'pretty': self.pretty_cref(),
+            'confidence': self.book_confidence,
+            }
+
+    def canonical_range(self):
+        """
+        Return the passage as numbers: (book, first chapter, first verse,
+        last chapter, last verse). A missing last verse is None (end of the
+        chapter), so every spelling of the same reference gives the same value.
+        """
+        if self.verse_last:
+            verse_last = int(self.verse_last)
+        else:
+            verse_last = None
+        return (self.book_number(self.book),
+            int(self.chapter_first),
+            int(self.verse_first or '1'),
+            int(self.chapter_last),
+            verse_last)
+
+    def sort_key(self, canon='protestant'):
+        """
+        Return an integer that sorts the reference by the book's place in
+        the canon (bible_books.canon_ranks), then where the passage starts,
+        then where it ends. A whole chapter comes before its first verse.
+        """
+        rank = bible_books.canon_ranks[canon][self.book_number(self.book)]
+        first = canonical_id(rank, self.chapter_first, self.verse_first or 0)
+        last = canonical_id(rank, self.chapter_last, self.verse_last or 999)
+        return first * 100000000 + last
+
+    def cache_key(self, kind, *extra):
+        """
+        Return the key a kind of value for the passage is cached and
+        coalesced under: the db, the version and the verses, and for what's
+        rendered (rendered_kinds) the binder too, since the reference in it
+        is written with the binder's book names
+        """
+        key = (kind, db_path, self.bible_version.lower(),
+            self.canonical_range())
+        if kind in self.rendered_kinds:
+            key += (self.book_name_binder.fingerprint(), self.pretty_cref())
+        return key + extra
+
     def clean(self, token):
         """
         Remove extraneous matter from the token
@@ -264,25 +513,50 @@ class BibleCrossReference():
     def book_clean(self, token):
         """
         use a regex and match the acceptable book names/abbr.
+        Returns the name's bible_books.lookup_key(), so it's only normalized
+        the once.
+        A name matched as a whole has a book_confidence of 1. Otherwise,
+        with fuzzy_confidence set, take the closest name if it's close
+        enough; without it, take the name found in the token, as always
+        (Genisis -> gen). Either way book_confidence says how close the
+        token is to the name.
         """
-        b_list = self.book_name_binder.book_list()
-        # escape periods
-        b_list = [b.replace(u'.', u'\.') for b in b_list]
-        b_list.sort(key=len, reverse=True)
-        # print '|'.join(b_list)
-        pat = re.compile('|'.join(b_list), re.IGNORECASE)
-        m = re.search(pat, token)
+        import bible_fuzzy
+        started = time.time()
+        pat = self.book_name_binder.book_name_pattern()
+        key = bible_books.lookup_key(token)
+        m = pat.search(key)
+        query = bible_fuzzy.book_query(key)
+        bible_metrics.stage_seconds.observe('book_clean',
+            time.time() - started)
         # print m.group()
-        if m is not None:
+        if m is not None and m.group() == query:
+            self.book_confidence = 1.0
             return m.group()
-        return None
+        if self.fuzzy_confidence is not None:
+            started = time.time()
+            found = self.book_name_binder.fuzzy_index().find(query)
+            bible_metrics.stage_seconds.observe('book_fuzzy',
+                time.time() - started)
+            if found is None or found[2] < self.fuzzy_confidence:
+                return None
+            self.book_confidence = found[2]
+            return found[1]
+        if m is None:
+            return None
+        self.book_confidence = 1.0 - float(bible_fuzzy.distance(query,
+            m.group())) / max(len(query), len(m.group()))
+        return m.group()
 
     def book_number(self, book_name):
         # needs to continue if the book name isn't in there for some reason
-        bn_dict = self.book_name_binder.book_name_to_number()
+        started = time.time()
         try:
-            bn = bn_dict[book_name]
-        except KeyError:
+            bn = self.book_name_binder.book_number(book_name)
+        finally:
+            bible_metrics.stage_seconds.observe('book_number',
+                time.time() - started)
+        if bn is None:
             raise VerseError(self.original)
         # print book_name
         return bn
@@ -323,8 +597,54 @@ class BibleCrossReference():
                 )
         return query
 
+    def sql_params(self, book, chapter, verse):
+        """
+        Parameterized version of sql_string. Returns (query, parameters).
+        The query text only depends on the version, so sqlite reuses the
+        compiled statement from its cache instead of compiling a new one for
+        every lookup.
+        """
+        if verse == 'max':
+            query = (
+                'SELECT %s FROM %s '
+                'WHERE book_num = ? '
+                'AND chapter_num = ? '
+                'ORDER BY verse_num DESC '
+                'LIMIT 1' % (lookup_columns, self.bible_version)
+                )
+            parameters = (int(self.book_number(book)), int(chapter))
+        else:
+            query = (
+                'SELECT %s FROM %s '
+                'WHERE book_num = ? '
+                'AND chapter_num = ? '
+                'AND verse_num = ?' % (lookup_columns, self.bible_version)
+                )
+            parameters = (int(self.book_number(book)), int(chapter),
+                int(verse))
+        return query, parameters
+
+    def id_sql_params(self, verse_id):
+        """
+        Look up a single verse by Id (for redirects)
+        """
+        query = 'SELECT %s FROM %s WHERE Id = ?' % (lookup_columns,
+            self.bible_version)
+        return query, (verse_id,)
+
+    def range_sql_params(self, start_id, end_id):
+        """
+        Look up every verse from start_id to end_id
+        """
+        query = (
+            'SELECT * from %s '
+            'WHERE Id BETWEEN ? AND ? '
+            'ORDER BY Id' % self.bible_version
+            )
+        return query, (start_id, end_id)
+
     def get_start_verse(self, the_cursor):
-        verse = the_cursor.execute(self.sql_string(self.book,
+        verse = the_cursor.execute(*self.sql_params(self.book,
             self.chapter_first,
             self.verse_first or '1'))
         start = the_cursor.fetchone()
@@ -333,31 +653,46 @@ class BibleCrossReference():
             raise VerseError(self.original)
         # redirects
         while start['see'] == 'previous':
-            verse = the_cursor.execute(
-                'SELECT * FROM %s '
-                'WHERE Id = %d' % (
-                    self.bible_version,
-                    start['Id'] - 1)
-                )
+            verse = the_cursor.execute(*self.id_sql_params(start['Id'] - 1))
             start = the_cursor.fetchone()
         return start
 
+    def versification(self, the_cursor):
+        """
+        Return the verse counts for this version (built on first use)
+        """
+        import bible_versification
+        return bible_versification.get_versification(self.bible_version,
+            the_cursor.connection, db_path)
+
+    def check_chapters(self, the_cursor):
+        """
+        Reject chapters the book doesn't have without querying for them
+        """
+        versification = self.versification(the_cursor)
+        book_num = self.book_number(self.book)
+        for chapter in [self.chapter_first, self.chapter_last]:
+            if not versification.has_chapter(book_num, chapter):
+                raise VerseError(self.original)
+
     def get_end_verse(self, the_cursor):
-        verse = the_cursor.execute(self.sql_string(self.book,
+        verse_last = self.verse_last
+        if not verse_last:
+            # look up the end of the chapter instead of sorting the chapter
+            verse_last = self.versification(the_cursor).last_verse(
+                self.book_number(self.book), self.chapter_last)
+            if verse_last is None:
+                raise VerseError(self.original)
+        verse = the_cursor.execute(*self.sql_params(self.book,
             self.chapter_last,
-            self.verse_last or 'max'))
+            verse_last))
         end = the_cursor.fetchone()
         # non-existent verses
         if end == None:
             raise VerseError(self.original)
         # redirects
         while end['see'] == 'next':
-            verse = the_cursor.execute(
-                'SELECT * FROM %s '
-                'WHERE Id = %d' % (
-                    self.bible_version,
-                    end['Id'] + 1)
-                )
+            verse = the_cursor.execute(*self.id_sql_params(end['Id'] + 1))
             end = the_cursor.fetchone()
         return end
 
@@ -366,7 +701,7 @@ class BibleCrossReference():
         Return the href that points to the first verse in the cref
         """
         book_num = self.book_number(self.book)
-        bns = bible_books.THPBibleTextAbbr()
+        bns = bible_books.book_name_system(bible_books.THPBibleTextAbbr)
         book = bns.book_dict[book_num]
         chap = self.chapter_first
         verse = self.verse_first or '1'
@@ -378,28 +713,114 @@ class BibleCrossReference():
         Take the cross-reference details and return the passage.
         This is where we need to access the relevant table of the db.
         """
-        import sqlite3
+        if self.cache is not None:
+            passage = self.cache.get(self.cache_key('rows'))
+            if passage is not None:
+                return passage
+        if self.coalescer is not None:
+            return self.coalescer.do(self.cache_key('rows'),
+                self.fetch_passage)
+        return self.fetch_passage()
+
+    def fetch_passage(self):
+        """
+        Read the passage from the db (and cache it)
+        """
+        import bible_db
         # by importing here instead of at the top of the module, we can use
         # this module in Sublime Text plugins
-        connect = sqlite3.connect(db_path)
-        connect.row_factory = sqlite3.Row
-        cursor = connect.cursor()
-        start = self.get_start_verse(cursor)
-        end = self.get_end_verse(cursor)
+        with bible_db.get_pool(db_path).connection() as connect:
+            cursor = connect.cursor()
+            passage = self.select_passage(cursor).fetchall()
+            # print '%d verses in passage %s' % (len(passage), self.original)
+        if self.cache is not None:
+            self.cache.set(self.cache_key('rows'), passage)
+        return passage
+
+    def select_passage(self, the_cursor):
+        """
+        Find the first and last verses and select everything between them.
+        Returns the cursor, ready to fetch the verses from.
+        """
+        self.check_chapters(the_cursor)
+        start = self.get_start_verse(the_cursor)
+        end = self.get_end_verse(the_cursor)
         if int(start['Id']) > int(end['Id']):
             raise VerseError(self.original)
-        verses = cursor.execute(
-            'SELECT * from %s '
-            'WHERE Id BETWEEN %d AND %d '
-            'ORDER BY Id' % (
-                self.bible_version,
-                start['Id'],
-                end['Id'])
-            )
-        passage = cursor.fetchall()
-        # print '%d verses in passage %s' % (len(passage), self.original)
-        connect.close()
-        return passage
+        the_cursor.execute(*self.range_sql_params(start['Id'], end['Id']))
+        return the_cursor
+
+    def iter_passage(self, rows_per_fetch=100):
+        """
+        Like get_passage, but return an iterator over the verses.
+        Passages that aren't cached are read from the db a few rows at a time
+        (and not cached), so a whole book never has to be in memory at once.
+        """
+        if self.cache is not None:
+            passage = self.cache.get(self.cache_key('rows'))
+            if passage is not None:
+                return iter(passage)
+        return self.read_passage(rows_per_fetch)
+
+    def read_passage(self, rows_per_fetch=100):
+        """
+        Yield the verses of the passage straight from the db
+        """
+        import bible_db
+        with bible_db.get_pool(db_path).connection() as connect:
+            cursor = connect.cursor()
+            try:
+                self.select_passage(cursor)
+                while True:
+                    verses = cursor.fetchmany(rows_per_fetch)
+                    if not verses:
+                        break
+                    for verse in verses:
+                        yield verse
+            finally:
+                cursor.close()
+
+    def in_version(self, bible_version):
+        """
+        Return a copy of the cross-reference that points to another version
+        """
+        cref = copy.copy(self)
+        cref.bible_version = bible_version
+        return cref
+
+    def get_passage_versions(self, bible_versions, errors=None):
+        """
+        Return a dictionary of version: passage, for showing the passage side
+        by side in several versions. The versions are looked up at the same
+        time on a shared pool of threads, so it takes about as long as the
+        slowest version instead of all of them added together.
+        A version that can't be looked up (no table for it in the db, say)
+        is left out, without holding up the others; pass a dictionary as
+        errors to get version: exception for those.
+        """
+        pool = version_pool()
+        lookups = [(version, pool.apply_async(
+            self.in_version(version).get_passage))
+            for version in bible_versions]
+        passages = {}
+        for version, lookup in lookups:
+            try:
+                passages[version] = lookup.get()
+            except Exception as X:
+                if errors is not None:
+                    errors[version] = X
+        return passages
+
+    def get_passage_async(self, executor=None):
+        """
+        Start get_passage on a background thread; return a PassageFuture.
+        See bible_executor for waiting with a timeout, cancelling, and
+        awaiting it from an event loop.
+        """
+        if executor == None:
+            import bible_executor
+            executor = bible_executor.passage_executor
+        return executor.submit(self.get_passage)
 
     def add_starts_ends(self, xml_text, class_context):
         """
@@ -421,44 +842,205 @@ class BibleCrossReference():
             xml_text = '%s<%s-end/>' % (xml_text, element)
         return xml_text
 
+    def verse_xml(self):
+        """
+        Return the verse-oriented xml of the passage, with the -start and
+        -end markers it needs to stand on its own.
+        """
+        passage = self.get_passage()
+        passage_xml = '\n'.join([verse['verse_text'] for verse in passage])
+        passage_xml = self.add_starts_ends(passage_xml,
+            passage[0]['class_context'])
+        return passage_xml
+
+    def passage_document(self, passage_xml):
+        """
+        Wrap verse-oriented xml in a <passage> with its reference
+        """
+        passage_xml = '<passage-reference>%s</passage-reference>\n%s' % (
+            self.pretty_cref(), passage_xml)
+        return '<passage>\n%s</passage>' % passage_xml
+
+    def iter_passage_document(self, rows_per_fetch=100):
+        """
+        Yield the same document as passage_document(verse_xml()) a piece at
+        a time, as the verses are read. Gives the same -start and -end
+        markers as add_starts_ends, but only has to look ahead as far as the
+        first marker to decide on the opening one.
+        """
+        verses = self.iter_passage(rows_per_fetch)
+        try:
+            first = verses.next()
+        except StopIteration:
+            raise VerseError(self.original)
+        element, cls = first['class_context'].split('.')
+        start_marker = '<%s-start' % element
+        end_marker = '<%s-end' % element
+        yield '<passage>\n<passage-reference>%s</passage-reference>\n' % (
+            self.pretty_cref())
+        # hold on to the verses until we know whether the first marker is a
+        # -start (nothing to add) or an -end (add a -start first)
+        held = []
+        opened = False
+        # which marker came last, and whether there's been an -end at all
+        last_marker = None
+        any_end = False
+        separator = ''
+        for verse in itertools.chain([first], verses):
+            text = verse['verse_text']
+            last_start = text.rfind(start_marker)
+            last_end = text.rfind(end_marker)
+            if last_start != -1 or last_end != -1:
+                if not opened:
+                    first_start = text.find(start_marker)
+                    first_end = text.find(end_marker)
+                    if first_start == -1 or (first_start > first_end and
+                            first_end != -1):
+                        yield '<%s-start class="%s"/>\n' % (element, cls)
+                    opened = True
+                    for piece in held:
+                        yield piece
+                    held = []
+                if last_start > last_end:
+                    last_marker = 'start'
+                else:
+                    last_marker = 'end'
+                any_end = any_end or last_end != -1
+            if opened:
+                yield separator
+                yield text
+            else:
+                held.extend([separator, text])
+            separator = '\n'
+        if not opened:
+            # no markers at all
+            yield '<%s-start class="%s"/>\n' % (element, cls)
+            for piece in held:
+                yield piece
+        if not any_end or last_marker == 'start':
+            yield '<%s-end/>' % element
+        yield '</passage>'
+
+    def iter_paragraph_xml(self, rows_per_fetch=100):
+        """
+        Yield the paragraph-oriented xml a piece at a time, as the verses
+        are read (the built-in equivalent of paragraph.xsl; no xslt)
+        """
+        import bible_paragraphs
+        return bible_paragraphs.assemble(
+            self.iter_passage_document(rows_per_fetch))
+
     def orient_to_paragraph(self, passage_xml,
             included_stylesheets):
         """
         Transform from verse-oriented to paragraph-oriented xml.
         """
-        import complib.xslt
-        stylesheet = open(r'xsl/copy_all.xsl', 'r').read()
-        includes = '\n'.join(
-            ['<xsl:include href="%s"/>' % ss for ss in included_stylesheets])
-        stylesheet = stylesheet.replace('<xsl:template ',
-            '%s\n<xsl:template ' % includes,
-            1)
-        fl = open(r'xsl/main.xsl', 'w')
-        fl.write(stylesheet)
-        fl.close()
-        result = StringIO.StringIO()
-        passage_xml = '<passage-reference>%s</passage-reference>\n%s' % (
-            self.pretty_cref(), passage_xml)
-        passage_xml = '<passage>\n%s</passage>' % passage_xml
-        stylesheet = complib.xslt.XSLT(r'xsl/main.xsl')
-        # stylesheet = complib.xslt.XSLT('paragraph.xsl')
-        passage_xml = stylesheet.transform(passage_xml)
-        passage_xml.write(result, method='xml', encoding='utf-8')
-        passage_xml = result.getvalue()
-        return passage_xml
+        from lxml import etree
+        passage_xml = self.passage_document(passage_xml)
+        stylesheet = compiled_stylesheet(included_stylesheets)
+        result = stylesheet(etree.XML(passage_xml))
+        root = result.getroot()
+        if root is None:
+            return serialize_nodes([])
+        nodes = list(root.itersiblings(preceding=True))
+        nodes.reverse()
+        return serialize_nodes(nodes + [root] + list(root.itersiblings()))
 
     def xml(self, included_stylesheets=['paragraph.xsl']):
         """
         Resolve the passage into valid xml
         """
-        passage = self.get_passage()
-        passage_xml = '\n'.join([verse['verse_text'] for verse in passage])
-        passage_xml = self.add_starts_ends(passage_xml,
-            passage[0]['class_context'])
-        passage_xml = self.orient_to_paragraph(passage_xml,
-            included_stylesheets)
+        if self.cache is not None:
+            passage_xml = self.cache.get(self.cache_key('xml',
+                tuple(included_stylesheets)))
+            if passage_xml is not None:
+                return passage_xml
+        if self.coalescer is not None:
+            return self.coalescer.do(
+                self.cache_key('xml', tuple(included_stylesheets)),
+                self.render_xml, included_stylesheets)
+        return self.render_xml(included_stylesheets)
+
+    def render_xml(self, included_stylesheets=['paragraph.xsl']):
+        """
+        Do the work of xml() (and cache the result)
+        """
+        passage_xml = self.render_without_xslt(included_stylesheets)
+        if passage_xml is None:
+            passage_xml = self.orient_to_paragraph(self.verse_xml(),
+                included_stylesheets)
+        if self.cache is not None:
+            self.cache.set(self.cache_key('xml', tuple(included_stylesheets)),
+                passage_xml)
         return passage_xml
 
+    def render_without_xslt(self, included_stylesheets=['paragraph.xsl']):
+        """
+        Return the xml from the built-in paragraph assembler or the
+        materialized store, whichever applies, or None if the passage has
+        to be transformed
+        """
+        if self.native_paragraphs and \
+                list(included_stylesheets) == ['paragraph.xsl']:
+            import bible_paragraphs
+            return ''.join(bible_paragraphs.assemble(
+                [self.passage_document(self.verse_xml())])).encode('utf-8')
+        if self.materialized is not None:
+            return self.materialized.passage_xml(self, included_stylesheets)
+        return None
+
+    def passage_dict(self):
+        """
+        Return the passage as plain data: the reference, its canonical
+        range, and the number and plain text of each verse
+        """
+        passage = self.get_passage()
+        first, last = passage[0], passage[-1]
+        return {
+            'reference': self.pretty_cref(),
+            'version': self.bible_version,
+            'book_number': self.book_number(self.book),
+            'first_id': canonical_id(first['book_num'], first['chapter_num'],
+                first['verse_num']),
+            'last_id': canonical_id(last['book_num'], last['chapter_num'],
+                last['verse_num']),
+            'verses': [{
+                'chapter': verse['chapter_num'],
+                'verse': verse['verse_num'],
+                'text': plain_text(verse['verse_text']),
+                } for verse in passage],
+            }
+
+    def json(self):
+        """
+        Resolve the passage into compact utf-8 json (see passage_dict).
+        No xml is built or transformed.
+        """
+        import json
+        return unicode(json.dumps(self.passage_dict(), separators=(',', ':'),
+            ensure_ascii=False)).encode('utf-8')
+
+    def text(self):
+        """
+        Resolve the passage into plain utf-8 text: the reference on the
+        first line, then one verse per line, starting with its number
+        """
+        lines = [self.pretty_cref()]
+        for verse in self.get_passage():
+            lines.append(u'%s %s' % (verse['verse_num'],
+                plain_text(verse['verse_text'])))
+        return u'\n'.join(lines).encode('utf-8')
+
+    def xml_async(self, included_stylesheets=['paragraph.xsl'],
+            executor=None):
+        """
+        Start xml() on a background thread; return a PassageFuture.
+        """
+        if executor == None:
+            import bible_executor
+            executor = bible_executor.passage_executor
+        return executor.submit(self.xml, included_stylesheets)
+
 
 class VerseError(Exception):
     """
@@ -468,6 +1050,75 @@ class VerseError(Exception):
 
     def __str__(self):
         return 'Could not resolve cross-reference: %s' % self.original
+
+
+def xml_batch(crefs, included_stylesheets=['paragraph.xsl']):
+    """
+    Resolve many cross-references into xml, with a single transform for
+    all the ones that need the xslt (see BibleCrossReference.render_xml):
+    their <passage>s go into one document, each in a <batch-passage> with
+    its index, the document is transformed once, and what each
+    <batch-passage> holds afterwards is its cref's xml.
+    Returns a list of (xml, error) in the same order as crefs: the string
+    cref.xml() gives and None, or None and the exception for a cref that
+    couldn't be resolved.
+    """
+    from lxml import etree
+    results = [(None, None)] * len(crefs)
+    # (index, verse-oriented <passage>) for the ones to transform
+    pending = []
+    for i, cref in enumerate(crefs):
+        try:
+            key = cref.cache_key('xml', tuple(included_stylesheets))
+            passage_xml = None
+            if cref.cache is not None:
+                passage_xml = cref.cache.get(key)
+            if passage_xml is None:
+                passage_xml = cref.render_without_xslt(included_stylesheets)
+                if passage_xml is not None and cref.cache is not None:
+                    cref.cache.set(key, passage_xml)
+            if passage_xml is None:
+                pending.append((i, cref.passage_document(cref.verse_xml())))
+            else:
+                results[i] = (passage_xml, None)
+        except (TypeError, VerseError) as X:
+            results[i] = (None, X)
+    if not pending:
+        return results
+    stylesheet = compiled_stylesheet(included_stylesheets)
+    # index -> what its <batch-passage> holds after the transform
+    transformed = {}
+    try:
+        root = stylesheet(etree.XML('<passages>%s</passages>' % ''.join(
+            ['<batch-passage id="%d">%s</batch-passage>' % (i, document)
+                for i, document in pending]))).getroot()
+    except etree.LxmlError:
+        root = None
+    if root is not None:
+        seen = set()
+        for wrapper in root.iter('batch-passage'):
+            i = wrapper.get('id')
+            if i in seen:
+                # copied more than once, so it can't be told apart
+                transformed.pop(i, None)
+            else:
+                transformed[i] = list(wrapper)
+            seen.add(i)
+    for i, document in pending:
+        if str(i) not in transformed:
+            # the stylesheets didn't keep its <batch-passage> (or one of
+            # the passages broke the document), so do it on its own
+            try:
+                results[i] = (crefs[i].xml(included_stylesheets), None)
+            except (TypeError, VerseError) as X:
+                results[i] = (None, X)
+            continue
+        passage_xml = serialize_nodes(transformed[str(i)])
+        results[i] = (passage_xml, None)
+        if crefs[i].cache is not None:
+            crefs[i].cache.set(crefs[i].cache_key('xml',
+                tuple(included_stylesheets)), passage_xml)
+    return results
         
         
 def tester():
@@ -160,6 +160,14 @@ class BookNameRegEx(RegExTerm):
     def __init__(self, optional=False):
         RegExTerm.__init__(self, optional)
 
+    def _escape_chars(self, an_exp, space=False):
+        """
+        Escape periods, and let any separator stand between the words of a
+        name (see bible_books.separator)
+        """
+        escaped = an_exp.replace(u'.', u'\.')
+        return escaped.replace(u' ', bible_books.separator)
+
     def include(self, a_list):
         """
         When adding book names, add singular "Psalm" and "Salmo"
@@ -179,8 +187,37 @@ class BookNameRegEx(RegExTerm):
         RegExTerm.include(self, a_list)
 
 
+class OriginalMatch():
+    """
+    A match in the normalized copy of a text (see bible_books.normalize_spaces)
+    that gives back the text of the original
+    """
+    def __init__(self, match, text):
+        self.match = match
+        self.text = text
+
+    def group(self, *groups):
+        if not groups:
+            groups = (0,)
+        found = []
+        for group in groups:
+            start, end = self.match.span(group)
+            if start == -1:
+                found.append(None)
+            else:
+                found.append(self.text[start:end])
+        if len(found) == 1:
+            return found[0]
+        return tuple(found)
+
+    def __getattr__(self, name):
+        return getattr(self.match, name)
+
+
 class BibleRefRegEx():
     """Grabs bible refs that begin with a book name.
+    Any kind of space can separate the words of a book name from each other
+    and from the chapter.
     """
     def __init__(self, book_name_binder):
         booker = BookNameRegEx()
@@ -190,9 +227,7 @@ class BibleRefRegEx():
         #    'chapters', 'chaps', 'chs'])
         self.book_names = booker.construct()
         # print self.book_names.encode('utf-8')
-        spacer = SpaceRegEx()
-        spacer.include([u'\u00a0'])
-        self.space = spacer.construct()
+        self.space = bible_books.separator
         numberer = BibleNumberRefRegEx()
         self.number = numberer.construct()
         ranger = RangeMarkerRegEx()
@@ -238,21 +273,31 @@ class BibleRefRegEx():
         Return all matches in text
         """
         # print self.pattern.encode('utf-8')
+        normalized = bible_books.normalize_spaces(text)
         hits = []
         position = 0
         while True:
-            hit = re.search(self.pattern, text[position:], re.IGNORECASE)
+            hit = re.search(self.pattern, normalized[position:], re.IGNORECASE)
             if hit is None:
                 break
-            hits.append(hit.group(0))
+            hits.append(text[position + hit.start():position + hit.end()])
             position += hit.end()
         return hits
 
     def sub(self, replace_method, text):
         """
-        Replace each hit with the value defined in replace_method
+        Replace each hit with the value defined in replace_method.
+        replace_method gets an OriginalMatch.
         """
-        text = re.sub(self.pattern, replace_method, text)
+        normalized = bible_books.normalize_spaces(text)
+        pieces = []
+        position = 0
+        for hit in re.finditer(self.pattern, normalized):
+            pieces.append(text[position:hit.start()])
+            pieces.append(replace_method(OriginalMatch(hit, text)))
+            position = hit.end()
+        pieces.append(text[position:])
+        text = ''.join(pieces)
         # position = 0
         # while True:
         #     hit = re.search(self.pattern, text[position:], re.IGNORECASE)
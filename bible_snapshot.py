@@ -0,0 +1,183 @@
+#bible_snapshot.py
+"""
+Save what a BookNameBinder works out from its systems to a file, so the
+next process doesn't have to work it out again.
+A snapshot keeps which systems the binder has (by class and options;
+they're made again on loading, which is quick), the derived values, and
+the regex's source and flags. Nothing but plain data is pickled. The fuzzy
+index isn't in it: it takes longer to unpickle than everything else
+together, and it's only needed (and built) for the first misspelled book
+name.
+
+What it saves is about half the work. For the six systems rest.py uses,
+making the binder's book list, dictionary, regex and fingerprint takes
+about 9ms; loading them takes about 5ms, and 4ms of that is re.compile()
+of the book name regex. The compiled regex can't be saved without
+pickling the re module's internals (which differ between pythons), so it
+is compiled again on every load.
+
+A snapshot only loads in the format version it was written in, and only
+with the bible_books.py it was made from (it keeps a hash of the source),
+so a change to the names can't be hidden by an old file. Loading raises
+SnapshotError for one that's out of date; binder() just makes a new one.
+
+Only binders made of shared systems (bible_books.book_name_system) can be
+saved. Loading one gives every binder of the same shared systems the saved
+values.
+
+usage:
+save(bnb, 'binder.snapshot')
+bnb = load('binder.snapshot')
+bnb = binder('binder.snapshot', [bible_books.THPFullName,
+    (bible_books.THPFullName, {'nbs': u'\\u00a0'})])
+
+python bible_snapshot.py binder.snapshot   # the binder rest.py uses
+(rest.py loads it from $BIBLE_BINDER_SNAPSHOT; see there)
+"""
+import cPickle
+import hashlib
+import os
+import re
+import sys
+
+import bible_books
+
+format_version = 2
+
+
+class SnapshotError(Exception):
+    """
+    The snapshot is from another format version or another bible_books.py,
+    so it has to be made again
+    """
+
+
+def source_fingerprint():
+    """
+    Return a hash of bible_books.py, where the systems are defined
+    """
+    path = os.path.splitext(bible_books.__file__)[0] + '.py'
+    try:
+        fl = open(path, 'rb')
+    except IOError:
+        raise SnapshotError('can\'t read %s to check snapshots against' %
+            path)
+    try:
+        return hashlib.sha1(fl.read()).hexdigest()
+    finally:
+        fl.close()
+
+def _shared_key(system):
+    for key, shared in bible_books._systems.items():
+        if shared is system:
+            return key
+    raise ValueError('only binders of shared systems '
+        '(bible_books.book_name_system) can be saved')
+
+def save(binder, path):
+    """
+    Write the binder and everything it derives from its systems to a file.
+    The file is written next to the path and then moved there, so a
+    process loading it never sees half of it.
+    """
+    systems = []
+    for system in binder.book_name_systems:
+        system_class, options = _shared_key(system)
+        systems.append((system_class.__name__, options))
+    pattern = binder.book_name_pattern()
+    data = {
+        'format': format_version,
+        'source': source_fingerprint(),
+        'systems': systems,
+        'book_list': tuple(binder.book_list()),
+        'name_to_number': binder.book_name_to_number(),
+        'pattern': (pattern.pattern, pattern.flags),
+        'fingerprint': binder.fingerprint(),
+        }
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    fl = open(temporary, 'wb')
+    try:
+        cPickle.dump(data, fl, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        fl.close()
+    os.rename(temporary, path)
+
+def read(path):
+    """
+    Return the contents of a snapshot, or raise SnapshotError if it's out
+    of date
+    """
+    fl = open(path, 'rb')
+    try:
+        try:
+            data = cPickle.load(fl)
+        except Exception as X:
+            raise SnapshotError('%s isn\'t a snapshot: %s' % (path, X))
+    finally:
+        fl.close()
+    if not isinstance(data, dict) or data.get('format') != format_version:
+        raise SnapshotError('%s is from another version of bible_snapshot' %
+            path)
+    if data['source'] != source_fingerprint():
+        raise SnapshotError('%s was made from another bible_books.py' % path)
+    return data
+
+def load(path):
+    """
+    Return a BookNameBinder from a snapshot, with its book list,
+    dictionary, regex and fingerprint ready (the regex compiled again)
+    """
+    return _load(read(path))
+
+def _load(data):
+    systems = [bible_books.book_name_system(getattr(bible_books, name),
+        **dict(options)) for name, options in data['systems']]
+    source, flags = data['pattern']
+    derived = {
+        'book_list': data['book_list'],
+        'name_to_number': data['name_to_number'],
+        'pattern': re.compile(source, flags),
+        'fingerprint': data['fingerprint'],
+        }
+    for kind, value in derived.items():
+        bible_books._derived.setdefault((kind, tuple(systems)), value)
+    return bible_books.BookNameBinder(systems)
+
+def binder(path, system_classes):
+    """
+    Return a binder of the shared systems from a snapshot, if there's one
+    with just those systems; otherwise make the binder and save it (if the
+    path can be written). Each system is a class, or (class, options).
+    With no path, just make the binder.
+    """
+    keys = []
+    for system_class in system_classes:
+        options = {}
+        if isinstance(system_class, tuple):
+            system_class, options = system_class
+        system_class, options = bible_books.system_key(system_class,
+            **options)
+        keys.append((system_class.__name__, options))
+    if path is not None and os.path.exists(path):
+        try:
+            data = read(path)
+            if data['systems'] == keys:
+                return _load(data)
+        except (IOError, SnapshotError):
+            pass
+    made = bible_books.BookNameBinder([
+        bible_books.book_name_system(getattr(bible_books, name),
+            **dict(options)) for name, options in keys])
+    if path is not None:
+        try:
+            save(made, path)
+        except (IOError, OSError, SnapshotError):
+            pass
+    return made
+
+
+if __name__ == '__main__':
+    import rest
+    save(rest.bnb, sys.argv[1])
+    print 'saved %d systems to %s' % (len(rest.bnb.book_name_systems),
+        sys.argv[1])
@@ -0,0 +1,121 @@
+#bible_versification.py
+"""
+How many verses are in each chapter of each book, per version.
+The versions don't all divide chapters the same way (e.g., Malachi 4 in
+English is Malaquias 4 in some Spanish versions, but not in others), so each
+version gets its own table. A table is built with one query over the whole
+version table, or loaded from a json file shipped with the data.
+
+Lookups by book number and chapter number are plain list indexing, so
+"Ps 119" can find its last verse (176) without sorting the chapter, and
+"Gen 51" can be rejected without going to the db at all.
+
+usage:
+python bible_versification.py versification.json nlt ntv rvr
+"""
+import json
+import threading
+
+# (db path or file path, version) -> Versification
+_tables = {}
+_lock = threading.Lock()
+
+
+class Versification():
+    """
+    Verse counts per chapter per book for one version.
+    chapter_lengths maps a book number to a list of verse counts, where
+    chapter_lengths[book][0] is the number of verses in chapter 1.
+    """
+    def __init__(self, version, chapter_lengths=None):
+        if chapter_lengths == None:
+            chapter_lengths = {}
+        self.version = version
+        self.chapter_lengths = chapter_lengths
+
+    def chapter_count(self, book_num):
+        """
+        Return the number of chapters in the book (0 if it isn't there)
+        """
+        return len(self.chapter_lengths.get(int(book_num), []))
+
+    def has_chapter(self, book_num, chapter_num):
+        return 1 <= int(chapter_num) <= self.chapter_count(book_num)
+
+    def last_verse(self, book_num, chapter_num):
+        """
+        Return the number of the last verse in the chapter,
+        or None if there is no such chapter.
+        """
+        if not self.has_chapter(book_num, chapter_num):
+            return None
+        return self.chapter_lengths[int(book_num)][int(chapter_num) - 1]
+
+    def to_dict(self):
+        # json keys have to be strings
+        return dict([(str(book), lengths) for book, lengths in
+            self.chapter_lengths.iteritems()])
+
+
+def build(version, connection):
+    """
+    Build the table for a version from the db in a single query
+    """
+    rows = connection.execute(
+        'SELECT book_num, chapter_num, MAX(verse_num) FROM %s '
+        'GROUP BY book_num, chapter_num '
+        'ORDER BY book_num, chapter_num' % version).fetchall()
+    chapter_lengths = {}
+    for book_num, chapter_num, last_verse in rows:
+        lengths = chapter_lengths.setdefault(int(book_num), [])
+        # leave a gap (0 verses) for any chapter missing from the db
+        while len(lengths) < int(chapter_num) - 1:
+            lengths.append(0)
+        lengths.append(int(last_verse))
+    return Versification(version, chapter_lengths)
+
+def get_versification(version, connection, db_path):
+    """
+    Return the table for the version, building it from the db the first
+    time it's asked for.
+    """
+    key = (db_path, version.lower())
+    table = _tables.get(key)
+    if table is None:
+        with _lock:
+            table = _tables.get(key)
+            if table is None:
+                table = build(version, connection)
+                _tables[key] = table
+    return table
+
+def load(path, db_path):
+    """
+    Load tables saved with save() and use them for the db at db_path
+    """
+    fl = open(path, 'r')
+    data = json.load(fl)
+    fl.close()
+    for version, books in data.iteritems():
+        chapter_lengths = dict([(int(book), lengths) for book, lengths in
+            books.iteritems()])
+        _tables[(db_path, version.lower())] = Versification(version,
+            chapter_lengths)
+
+def save(path, tables):
+    """
+    Write a list of Versification objects to a json file
+    """
+    data = dict([(table.version, table.to_dict()) for table in tables])
+    fl = open(path, 'w')
+    json.dump(data, fl, sort_keys=True)
+    fl.close()
+
+
+if __name__ == '__main__':
+    import sys
+    import bible_db
+    connection = bible_db.connect()
+    versions = sys.argv[2:] or bible_db.version_tables(connection)
+    save(sys.argv[1], [build(version, connection) for version in versions])
+    connection.close()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+#loadtest.py
+"""
+Measure the throughput and latency of the passages service.
+Starts rest_server.py on a local port (or uses --url), sends it a mix of
+reference strings from several threads, and reports requests per second
+and latency percentiles. Each response's status is checked against what
+its kind should get (see expected_status); the run fails if any is off.
+
+The mix is made up ahead of time from a seeded random generator, so two
+runs with the same options send exactly the same requests in the same
+order, and their numbers can be compared. It has (see default_mix):
+    english         full English book names
+    abbreviation    English abbreviations
+    spanish         Spanish names and abbreviations
+    nbs             numbered books with a no-break space after the number
+    chain           long strings of references separated by ; and ,
+    invalid         strings that don't parse (unknown books, junk)
+    hot             a few references asked for over and over, like the
+                    verse of the day
+Most references are made up from random chapters and verses, so apart
+from the hot ones they don't all come out of the response cache.
+
+With --rate, requests are sent on a fixed schedule (open loop), and each
+one's latency is measured from when it was due, not when a thread got to
+it, so a server that falls behind shows it in the numbers. Without --rate,
+each thread sends its next request as soon as it has the last response.
+
+usage:
+python loadtest.py --requests 5000 --concurrency 16 --workers 4
+python loadtest.py --rate 200 --requests 6000 --json before.json
+python loadtest.py --url http://localhost:8080 --requests 1000
+"""
+import httplib
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+import bible_books
+
+# the share of each kind of reference string in the mix
+default_mix = {
+    'english': 30,
+    'abbreviation': 20,
+    'spanish': 15,
+    'nbs': 10,
+    'chain': 5,
+    'invalid': 5,
+    'hot': 15,
+    }
+
+hot_references = [
+    u'John 3:16',
+    u'Jeremiah 29:11',
+    u'Philippians 4:13',
+    u'Romans 8:28',
+    u'Proverbs 3:5-6',
+    u'Juan 3:16',
+    ]
+
+# none of these parse. Names a typo away from a real book don't belong
+# here (Hezekiah is taken for Ezekiel, Mormon for Romans), and neither do
+# bare chapters and verses (3:16 is in the default book).
+invalid_references = [
+    u'Book of Mormon 1:1',
+    u'xyzzy 3:16',
+    u'1 Enoch 1:9',
+    u'asdf',
+    u'John :',
+    u'Gen 1:1; Opus 5',
+    u';;',
+    u'Gen ;',
+    ]
+
+
+def service_parses(name):
+    """
+    Whether the service takes a reference to the book by this name. Some
+    names in the systems don't get through its tokenizer (Cantar de los
+    Cantares, the Spanish 1 P and 2 P), so references made of them would
+    be invalid ones.
+    """
+    import rest
+    try:
+        return len(rest.pretty_crefs(u'%s 1:1' % name)) == 1
+    except Exception:
+        return False
+
+def book_names(kind):
+    """
+    Return the book names to make references of the given kind from (the
+    ones the service parses)
+    """
+    return [name for name in _book_names(kind) if service_parses(name)]
+
+def _book_names(kind):
+    system = bible_books.book_name_system
+    if kind == 'english':
+        systems = [system(bible_books.THPFullName)]
+    elif kind == 'abbreviation':
+        systems = [system(bible_books.THPBibleTeamAbbr),
+            system(bible_books.THPNLTSBAbbr)]
+    elif kind == 'spanish':
+        systems = [system(bible_books.THPSpanishFullName),
+            system(bible_books.THPSpanishBibleTeamAbbr)]
+    elif kind == 'nbs':
+        systems = [system(bible_books.THPFullName, nbs=u'\u00a0'),
+            system(bible_books.THPBibleTeamAbbr, nbs=u'\u00a0'),
+            system(bible_books.THPSpanishFullName, nbs=u'\u00a0')]
+        return [name for system in systems for name in system.book_list()
+            if u'\u00a0' in name]
+    return [name for system in systems for name in system.book_list()]
+
+def random_reference(rng, names):
+    """
+    Return a reference to a random passage in one of the books
+    """
+    book = rng.choice(names)
+    chapter = rng.randint(1, 20)
+    verse = rng.randint(1, 30)
+    form = rng.randint(0, 4)
+    if form == 0:
+        return u'%s %d' % (book, chapter)
+    if form == 1:
+        return u'%s %d:%d' % (book, chapter, verse)
+    if form == 2:
+        return u'%s %d:%d-%d' % (book, chapter, verse,
+            verse + rng.randint(1, 10))
+    if form == 3:
+        return u'%s %d:%d\u2013%d:%d' % (book, chapter, verse, chapter + 1,
+            rng.randint(1, 30))
+    return u'%s %d:%d, %d' % (book, chapter, verse, verse + rng.randint(2, 5))
+
+def random_chain(rng, names):
+    """
+    Return a long string of references, some of them without a book name
+    (carried over from the one before)
+    """
+    pieces = [random_reference(rng, names)]
+    for i in range(rng.randint(8, 25)):
+        if rng.random() < 0.3:
+            pieces.append(u'%d:%d' % (rng.randint(1, 20), rng.randint(1, 30)))
+        else:
+            pieces.append(random_reference(rng, names))
+    return u'; '.join(pieces)
+
+def make_references(count, seed=0, mix=default_mix):
+    """
+    Return [(kind, reference string)]; the same arguments always give the
+    same list
+    """
+    rng = random.Random(seed)
+    names = dict([(kind, book_names(kind)) for kind in
+        ['english', 'abbreviation', 'spanish', 'nbs']])
+    all_names = [name for kind in sorted(names) for name in names[kind]]
+    kinds = []
+    for kind in sorted(mix):
+        kinds.extend([kind] * mix[kind])
+    references = []
+    for i in range(count):
+        kind = rng.choice(kinds)
+        if kind == 'hot':
+            reference = rng.choice(hot_references)
+        elif kind == 'invalid':
+            reference = rng.choice(invalid_references)
+        elif kind == 'chain':
+            reference = random_chain(rng, all_names)
+        else:
+            reference = random_reference(rng, names[kind])
+        references.append((kind, reference))
+    return references
+
+def expected_status(kind):
+    """
+    The status the service should answer a reference of this kind with
+    (rest.py answers one it can't parse with a 500)
+    """
+    if kind == 'invalid':
+        return 500
+    return 200
+
+def percentile(ordered, fraction):
+    """
+    The nearest-rank percentile of a sorted list
+    """
+    if not ordered:
+        return None
+    rank = int(round(fraction * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+class LoadTest():
+    """
+    Sends a list of references to the service and records how each went
+    """
+    def __init__(self, host, port, references, concurrency=8, rate=None,
+            timeout=30):
+        self.host = host
+        self.port = port
+        self.references = references
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timeout = timeout
+        # (kind, status, seconds); status is None if the request failed
+        self.results = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def request(self, reference):
+        """
+        GET /passages/<reference> and return the status
+        """
+        path = '/passages/' + urllib.quote(reference.encode('utf-8'), safe='')
+        connection = httplib.HTTPConnection(self.host, self.port,
+            timeout=self.timeout)
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    def _work(self, started):
+        while True:
+            with self._lock:
+                i = self._next
+                self._next += 1
+            if i >= len(self.references):
+                return
+            kind, reference = self.references[i]
+            if self.rate:
+                due = started + i / float(self.rate)
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            else:
+                due = time.time()
+            try:
+                status = self.request(reference)
+            except Exception:
+                status = None
+            finished = time.time()
+            with self._lock:
+                self.results.append((kind, status, finished - due))
+
+    def run(self):
+        """
+        Send every reference and return the seconds it took
+        """
+        self.results = []
+        self._next = 0
+        started = time.time()
+        threads = [threading.Thread(target=self._work, args=(started,))
+            for i in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - started
+
+    def summary(self, elapsed):
+        """
+        Return the numbers for a run as a dictionary
+        """
+        latencies = sorted([seconds for kind, status, seconds
+            in self.results])
+        statuses = {}
+        # kind -> requests that didn't get expected_status(kind)
+        unexpected = {}
+        for kind, status, seconds in self.results:
+            if status != expected_status(kind):
+                unexpected[kind] = unexpected.get(kind, 0) + 1
+            status = str(status) if status is not None else 'failed'
+            statuses[status] = statuses.get(status, 0) + 1
+        kinds = {}
+        for kind in set([kind for kind, status, seconds in self.results]):
+            ordered = sorted([seconds for k, status, seconds in self.results
+                if k == kind])
+            kinds[kind] = {'requests': len(ordered),
+                'p50': percentile(ordered, 0.5),
+                'p99': percentile(ordered, 0.99)}
+        return {
+            'requests': len(self.results),
+            'seconds': elapsed,
+            'throughput': len(self.results) / elapsed if elapsed else None,
+            'statuses': statuses,
+            'unexpected': unexpected,
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+            'kinds': kinds,
+            }
+
+
+def start_server(port, workers, log=None, python=sys.executable):
+    """
+    Start rest_server.py on a local port and wait until it answers.
+    Its output (including a traceback for every 500) goes to the log file,
+    or nowhere.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    command = [python, os.path.join(here, 'rest_server.py'),
+        '--host', '127.0.0.1', '--port', str(port)]
+    if workers:
+        command.extend(['--workers', str(workers)])
+    out = open(log or os.devnull, 'w')
+    server = subprocess.Popen(command, cwd=here, stdout=out,
+        stderr=subprocess.STDOUT)
+    out.close()
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('rest_server.py exited with %d' %
+                server.returncode)
+        try:
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/metrics')
+            connection.getresponse().read()
+            connection.close()
+            return server
+        except Exception:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('rest_server.py didn\'t start answering in time')
+
+def print_summary(summary, out=sys.stdout):
+    def ms(seconds):
+        if seconds is None:
+            return '-'
+        return '%.2fms' % (seconds * 1000)
+    out.write('%d requests in %.2fs: %.1f requests/s\n' % (
+        summary['requests'], summary['seconds'], summary['throughput'] or 0))
+    out.write('latency p50 %s  p95 %s  p99 %s  max %s\n' % (
+        ms(summary['p50']), ms(summary['p95']), ms(summary['p99']),
+        ms(summary['max'])))
+    out.write('statuses: %s\n' % ', '.join(['%s: %d' % (status, count)
+        for status, count in sorted(summary['statuses'].items())]))
+    if summary['unexpected']:
+        out.write('UNEXPECTED statuses: %s\n' % ', '.join(['%s: %d' % (kind,
+            count) for kind, count in sorted(summary['unexpected'].items())]))
+    for kind, numbers in sorted(summary['kinds'].items()):
+        out.write('  %-13s %6d  p50 %s  p99 %s\n' % (kind,
+            numbers['requests'], ms(numbers['p50']), ms(numbers['p99'])))
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description='Load test the passages service.')
+    arg_parser.add_argument('--url', default=None,
+        help='test a service that\'s already running instead of starting one')
+    arg_parser.add_argument('--port', type=int, default=8099,
+        help='port to start the service on')
+    arg_parser.add_argument('--workers', type=int, default=None,
+        help='worker processes for rest_server.py (default: one per core)')
+    arg_parser.add_argument('--server-log', default=None,
+        help='write the service\'s output to this file')
+    arg_parser.add_argument('--requests', type=int, default=2000)
+    arg_parser.add_argument('--warmup', type=int, default=100,
+        help='requests to send (and not measure) before the run')
+    arg_parser.add_argument('--concurrency', type=int, default=8)
+    arg_parser.add_argument('--rate', type=float, default=None,
+        help='requests per second (default: as fast as possible)')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--json', default=None,
+        help='also write the options and results to this file')
+    args = arg_parser.parse_args()
+
+    server = None
+    if args.url:
+        url = urlparse.urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        host, port = '127.0.0.1', args.port
+        server = start_server(port, args.workers, args.server_log)
+    try:
+        references = make_references(args.warmup + args.requests, args.seed)
+        if args.warmup:
+            LoadTest(host, port, references[:args.warmup],
+                args.concurrency).run()
+        test = LoadTest(host, port, references[args.warmup:],
+            args.concurrency, args.rate)
+        summary = test.summary(test.run())
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    print_summary(summary)
+    if args.json:
+        fl = open(args.json, 'w')
+        json.dump({'options': vars(args), 'results': summary}, fl, indent=2,
+            sort_keys=True)
+        fl.close()
+    if summary['unexpected']:
+        sys.exit(1)
@@ -1,27 +1,159 @@
 #!/usr/bin/env python
 # modified from http://www.dreamsyssoft.com/python-scripting-tutorial/create-simple-rest-web-service-with-python.php
+import hashlib
+import json
+import os
+import time
+import unicodedata
 import web
-from lxml import etree
 import bible_books
+import bible_cache
+import bible_coalesce
+import bible_metrics
 import bible_parser
+import bible_snapshot
 
 base_systems = [
-            bible_books.THPFullName(),
-            bible_books.THPFullName(nbs=u'\u00a0'),
-            bible_books.THPFullNameSongs(),
-            bible_books.THPBibleTeamAbbr(),
-            bible_books.THPBibleTeamAbbr(nbs=u'\u00a0'),
-            bible_books.THPNLTSBAbbr(),#Prov and Hagg
-            bible_books.THPNLTSBAbbr(nbs=u'\u00a0'),
-            bible_books.THPSpanishFullName(),
-            bible_books.THPSpanishFullName(nbs=u'\u00a0'),
-            bible_books.THPSpanishBibleTeamAbbr(),
-            bible_books.THPSpanishBibleTeamAbbr(nbs=u'\u00a0'),
+            bible_books.THPFullName,
+            bible_books.THPFullNameSongs,
+            bible_books.THPBibleTeamAbbr,
+            bible_books.THPNLTSBAbbr,#Prov and Hagg
+            bible_books.THPSpanishFullName,
+            bible_books.THPSpanishBibleTeamAbbr,
         ]
-bnb = bible_books.BookNameBinder(base_systems)
+# With BIBLE_BINDER_SNAPSHOT set (before this module is imported; see
+# rest_server.py --binder-snapshot), the binder and everything it works out
+# from the systems are loaded from that file, which is made (again) whenever
+# it's missing or out of date. Without it, the binder is made from scratch.
+binder_snapshot = os.environ.get('BIBLE_BINDER_SNAPSHOT') or None
+bnb = bible_snapshot.binder(binder_snapshot, base_systems)
+# The parser doesn't keep anything between calls to tokenize and parse,
+# so one parser can serve every request.
+crp = bible_parser.CrossReferenceParser(
+    # bible_version="NTV",
+    # default_book="Obadiah",
+    book_name_binder=bnb)
+
+# The response to /passages/... depends only on the reference string and the
+# binder, so it can be cached here and by anyone downstream.
+response_cache = bible_cache.ByteBudgetCache(max_bytes=8 * 1024 * 1024)
+cache_control = 'public, max-age=86400'
+# identical requests that arrive together are parsed once
+response_coalescer = bible_coalesce.Coalescer('response')
+
+# run through the parser at startup, before taking any requests
+warmup_references = [
+    u'Genesis 1:1',
+    u'John 3:16, 18',
+    u'Ps 119:105\u2013112',
+    u'1 Cor 13; 2\u00a0Cor 5:17',
+    u'Hebrews 5:5; and 2 Peter 1:17',
+    u'Rom 8:28-39; 12:1-2',
+    u'Juan 3:16',
+    u'Salmo 23',
+    ]
+
+def pretty_crefs(passages):
+    """
+    Return the pretty form of each cross-reference in the string
+    """
+    to_return = []
+    started = time.time()
+    tokens = list(crp.tokenize(passages))
+    bible_metrics.stage_seconds.observe('tokenize', time.time() - started)
+    for token_type, pos, token in tokens:
+        bible_metrics.tokens.inc(token_type)
+    started = time.time()
+    crefs = list(crp.parse(tokens))
+    bible_metrics.stage_seconds.observe('parse', time.time() - started)
+    for cref in crefs:
+        if cref.ignore == False:
+            started = time.time()
+            to_return.append(cref.pretty_cref())
+            bible_metrics.stage_seconds.observe('pretty_cref',
+                time.time() - started)
+            # to_return.append(str((cref.book_number(cref.book), int(cref.chapter_first),
+            #     int(cref.chapter_last), int(cref.verse_first), int(cref.verse_last))))
+    return to_return
+
+def passages_response(reference):
+    """
+    Return (and cache) the response for a normalized reference string
+    """
+    response = '; '.join(pretty_crefs(reference))
+    response_cache.set(reference, response)
+    return response
+
+def normalize_reference(passages):
+    """
+    Put the reference string in the form the cache and the ETag are keyed by
+    """
+    return unicodedata.normalize('NFC', web.safeunicode(passages))
+
+def etag(reference):
+    """
+    Return the ETag for a normalized reference string.
+    Includes the binder's fingerprint, so that a change to the book names
+    changes every ETag.
+    """
+    digest = hashlib.sha1(bnb.fingerprint())
+    digest.update(reference.encode('utf-8'))
+    return '"%s"' % digest.hexdigest()
+
+def etag_matches(tag, if_none_match):
+    """
+    Test an If-None-Match header against an ETag
+    """
+    if if_none_match is None:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    tags = [t[2:] if t.startswith('W/') else t for t in tags]
+    return tag in tags or '*' in tags
+
+def batch_results(reference_strings):
+    """
+    Return a result for each reference string: the input, the references
+    found in it, and the error if it couldn't be parsed
+    """
+    results = []
+    for reference_string, crefs, error in crp.parse_many(reference_strings):
+        result = {'input': reference_string, 'references': [], 'error': None}
+        try:
+            result['references'] = [cref.reference_dict() for cref in crefs]
+        except bible_parser.VerseError as X:
+            error = X
+        if error is not None:
+            bible_metrics.errors.inc(error.__class__.__name__)
+            result['references'] = []
+            result['error'] = {'type': error.__class__.__name__,
+                'message': unicode(error)}
+        results.append(result)
+    return results
+
+def warmup():
+    """
+    Build the binder's dictionary and regex and run the parser over some
+    sample references, so the first requests don't pay for any of it
+    """
+    bnb.book_name_pattern()
+    bnb.book_name_to_number()
+    bnb.fingerprint()
+    # keep the warmup out of the metrics
+    metrics_enabled = bible_metrics.enabled
+    bible_metrics.enabled = False
+    try:
+        for reference in warmup_references:
+            try:
+                pretty_crefs(reference)
+            except (TypeError, bible_parser.VerseError):
+                pass
+    finally:
+        bible_metrics.enabled = metrics_enabled
 
 # what urls are acceptable?
 urls = (
+    '/passages', 'batch_passages',
+    '/metrics', 'metrics',
     '/passages/(.*)', 'get_passages'
 )
 
@@ -29,18 +161,53 @@ app = web.application(urls, globals())
 
 class get_passages:
     def GET(self, passages):
-        to_return = []
-        crp = bible_parser.CrossReferenceParser(
-            # bible_version="NTV",
-            # default_book="Obadiah",
-            book_name_binder=bnb)
-        for cref in crp.parse(crp.tokenize(passages)):
-            if cref.ignore == False:
-                to_return.append(cref.pretty_cref())
-                # to_return.append(str((cref.book_number(cref.book), int(cref.chapter_first),
-                #     int(cref.chapter_last), int(cref.verse_first), int(cref.verse_last))))
-        return '; '.join(to_return)
+        bible_metrics.requests.inc('passages')
+        reference = normalize_reference(passages)
+        response = response_cache.get(reference)
+        if response is None:
+            bible_metrics.cache.inc('miss')
+            try:
+                response = response_coalescer.do(reference,
+                    passages_response, reference)
+            except Exception as X:
+                bible_metrics.errors.inc(X.__class__.__name__)
+                # nobody downstream should keep an error
+                web.header('Cache-Control', 'no-store')
+                raise
+        else:
+            bible_metrics.cache.inc('hit')
+        # only a reference that resolved gets a validator and a lifetime
+        tag = etag(reference)
+        web.header('ETag', tag)
+        web.header('Cache-Control', cache_control)
+        if etag_matches(tag, web.ctx.env.get('HTTP_IF_NONE_MATCH')):
+            raise web.notmodified()
+        return response
+
+class batch_passages:
+    def POST(self):
+        """
+        Takes a json array of reference strings, e.g.
+        ["John 3:16, 18", "Ps 119"]
+        and returns a json array with a result for each (see batch_results)
+        """
+        bible_metrics.requests.inc('batch')
+        try:
+            reference_strings = json.loads(web.data())
+        except ValueError:
+            raise web.badrequest()
+        if not isinstance(reference_strings, list) or \
+                not all([isinstance(s, basestring) for s in reference_strings]):
+            raise web.badrequest()
+        web.header('Content-Type', 'application/json; charset=utf-8')
+        return json.dumps(batch_results(reference_strings))
+
+class metrics:
+    def GET(self):
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return bible_metrics.render()
 
 if __name__ == "__main__":
+    warmup()
     app.run()
     # open http://localhost:8080/books/Gen 1
\ No newline at end of file
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#rest_server.py
+"""
+Serve rest.py with several worker processes.
+app.run() in rest.py is fine for trying things out, but it's one process,
+so it never uses more than one core. This loads rest.py (binder, parser,
+compiled patterns, warmup) once, opens the listening socket, and then forks
+the workers, which all accept from that socket. Each worker handles its
+requests on threads, so a slow request doesn't hold up the others.
+
+The parent restarts any worker that dies. SIGTERM or Ctrl-C stops the
+workers gracefully: they stop accepting, finish the requests they have
+(giving up after shutdown_timeout seconds), and exit.
+
+Forking needs a unix; elsewhere this runs a single (threaded) process.
+
+usage:
+python rest_server.py --port 8080 --workers 4 --shutdown-timeout 30
+python rest_server.py --binder-snapshot /var/cache/bibleref/binder.snapshot
+"""
+import errno
+import os
+import signal
+import SocketServer
+import sys
+import threading
+import time
+import wsgiref.simple_server
+
+# how long (seconds) a stopping worker waits for the requests it has
+shutdown_timeout = 30
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+        wsgiref.simple_server.WSGIServer):
+    """
+    A WSGI server that handles each request on its own thread.
+    It keeps track of the threads, so a worker that's shutting down can
+    wait for the requests it's already working on (see join_requests).
+    """
+    daemon_threads = False
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        wsgiref.simple_server.WSGIServer.__init__(self, *args, **kwargs)
+        self._requests = set()
+        self._requests_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread,
+            args=(request, client_address))
+        thread.daemon = self.daemon_threads
+        with self._requests_lock:
+            self._requests.add(thread)
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request,
+                client_address)
+        finally:
+            with self._requests_lock:
+                self._requests.discard(threading.current_thread())
+
+    def join_requests(self, timeout=None):
+        """
+        Wait for the requests in progress to finish, for up to timeout
+        seconds (default: as long as they take). Return how many are
+        still running.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            with self._requests_lock:
+                running = list(self._requests)
+            if not running:
+                return 0
+            if timeout is None:
+                running[0].join()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return len(running)
+            running[0].join(remaining)
+
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """
+    Doesn't write a line to stderr for every request
+    """
+    def log_request(self, *args):
+        pass
+
+
+def load_app():
+    """
+    Import the service and get it ready for traffic
+    """
+    import rest
+    rest.warmup()
+    return rest.app.wsgifunc()
+
+def make_server(host, port, app):
+    server = ThreadingWSGIServer((host, port), QuietHandler)
+    server.set_app(app)
+    return server
+
+def run_worker(server):
+    """
+    Serve until SIGTERM, then let the requests in progress finish (for up
+    to shutdown_timeout seconds)
+    """
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever to return, so it can't be
+        # called from the thread that's running it
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    # Ctrl-C goes to the whole process group; leave it to the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server.serve_forever()
+    unfinished = server.join_requests(shutdown_timeout)
+    if unfinished:
+        sys.stderr.write('worker %d stopped with %d requests unfinished\n' %
+            (os.getpid(), unfinished))
+    server.server_close()
+
+def fork_worker(server):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(server)
+        finally:
+            # don't run the parent's cleanup (or return into its loop)
+            os._exit(0)
+    return pid
+
+def serve(host='0.0.0.0', port=8080, workers=None):
+    """
+    Run the service with a worker process per core (or workers of them)
+    """
+    if workers == None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    server = make_server(host, port, load_app())
+    if not hasattr(os, 'fork'):
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+        return
+
+    children = set()
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(workers):
+        children.add(fork_worker(server))
+    sys.stderr.write('serving on %s:%d with %d workers\n' % (host, port,
+        workers))
+    while children and not stopping:
+        try:
+            pid, status = os.wait()
+        except OSError as X:
+            if X.errno == errno.EINTR:
+                continue
+            raise
+        children.discard(pid)
+        if not stopping:
+            children.add(fork_worker(server))
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as X:
+            if X.errno == errno.EINTR:
+                continue
+            if X.errno == errno.ECHILD:
+                break
+            raise
+        children.discard(pid)
+    server.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description='Serve the passages service with several workers.')
+    arg_parser.add_argument('--host', default='0.0.0.0')
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--workers', type=int, default=None,
+        help='number of worker processes (default: one per core)')
+    arg_parser.add_argument('--binder-snapshot', default=None,
+        help='load the book name binder from this file, and make it if it\'s '
+            'missing or out of date (see bible_snapshot.py)')
+    arg_parser.add_argument('--shutdown-timeout', type=float,
+        default=shutdown_timeout,
+        help='seconds a stopping worker waits for its requests '
+            '(default: %(default)s)')
+    args = arg_parser.parse_args()
+    shutdown_timeout = args.shutdown_timeout
+    if args.binder_snapshot:
+        # rest.py reads it when it's imported
+        os.environ['BIBLE_BINDER_SNAPSHOT'] = os.path.abspath(
+            args.binder_snapshot)
+    serve(args.host, args.port, args.workers)
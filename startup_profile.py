@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#startup_profile.py
+"""
+Report where the time goes between starting python and parsing the first
+reference: each module import (as a tree, with the time spent in the
+module itself), making the parser, and the first parse.
+
+Run it in a fresh process (that's the point), and run it twice: the first
+run after an edit includes compiling the .pyc files.
+
+The target is for the command-line and plugin case, bible_parser on its
+own: first_parse_target from the first import to the first parsed
+reference. The exit status is 1 if it's missed, so it can go in a build.
+For the service, rest.py adds web.py, which is most of its own startup.
+
+usage:
+python startup_profile.py
+python startup_profile.py --module rest --reference "Juan 3:16"
+python startup_profile.py --min-ms 0
+"""
+import __builtin__
+import sys
+import time
+
+# seconds from the first import to the first parsed reference
+first_parse_target = 0.04
+
+_import = __builtin__.__import__
+
+
+class ImportTimer():
+    """
+    Times every import, nested the way they happen
+    """
+    def __init__(self):
+        # [depth, name, seconds, seconds in nested imports]
+        self.records = []
+        self._stack = []
+
+    def __call__(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return _import(name, *args, **kwargs)
+        record = [len(self._stack), name, 0.0, 0.0]
+        self.records.append(record)
+        self._stack.append(record)
+        started = time.time()
+        try:
+            return _import(name, *args, **kwargs)
+        finally:
+            record[2] = time.time() - started
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][3] += record[2]
+
+    def install(self):
+        __builtin__.__import__ = self
+
+    def uninstall(self):
+        __builtin__.__import__ = _import
+
+    def report(self, min_seconds=0.0005, out=sys.stdout):
+        out.write('%9s %9s  module\n' % ('total', 'self'))
+        for depth, name, seconds, nested in self.records:
+            if seconds < min_seconds:
+                continue
+            out.write('%7.1fms %7.1fms  %s%s\n' % (seconds * 1000,
+                (seconds - nested) * 1000, '  ' * depth, name))
+
+
+def profile(module_name='bible_parser', reference=u'John 3:16'):
+    """
+    Import the module, get a parser and parse one reference; return
+    (import timer, [(step, seconds)])
+    """
+    timer = ImportTimer()
+    timer.install()
+    try:
+        started = time.time()
+        module = __import__(module_name)
+        imported = time.time()
+    finally:
+        timer.uninstall()
+    import bible_parser
+    crp = getattr(module, 'crp', None)
+    if crp is None:
+        crp = bible_parser.CrossReferenceParser()
+    made = time.time()
+    for cref in crp.parse(crp.tokenize(reference)):
+        cref.pretty_cref()
+    parsed = time.time()
+    steps = [('import %s' % module_name, imported - started),
+        ('parser', made - imported),
+        ('first parse', parsed - made),
+        ('import to first parse', parsed - started)]
+    return timer, steps
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description='Profile imports and the time to the first parse.')
+    arg_parser.add_argument('--module', default='bible_parser',
+        help='the module to import (rest uses its own parser)')
+    arg_parser.add_argument('--reference', default='John 3:16')
+    arg_parser.add_argument('--min-ms', type=float, default=0.5,
+        help='leave out imports faster than this')
+    args = arg_parser.parse_args()
+    timer, steps = profile(args.module, args.reference.decode('utf-8'))
+    timer.report(args.min_ms / 1000)
+    print
+    for step, seconds in steps:
+        print '%-24s %7.1fms' % (step, seconds * 1000)
+    total = steps[-1][1]
+    print 'target %.1fms: %s' % (first_parse_target * 1000,
+        'met' if total <= first_parse_target else 'missed')
+    sys.exit(0 if total <= first_parse_target else 1)
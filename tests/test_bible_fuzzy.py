@@ -0,0 +1,68 @@
+#test_bible_fuzzy.py
+import unittest
+
+import bible_fuzzy
+
+names = {u'genesis': 1, u'gen': 1, u'exodus': 2, u'ex': 2, u'john': 43,
+    u'jn': 43, u'philippians': 50, u'phil': 50, u'jonah': 32}
+
+
+class DistanceTest(unittest.TestCase):
+    def test_distance(self):
+        self.assertEqual(bible_fuzzy.distance(u'genesis', u'genesis'), 0)
+        self.assertEqual(bible_fuzzy.distance(u'genisis', u'genesis'), 1)
+        # a swap of neighbours is one typo
+        self.assertEqual(bible_fuzzy.distance(u'jonh', u'john'), 1)
+        self.assertEqual(bible_fuzzy.distance(u'', u'ex'), 2)
+
+    def test_deletes(self):
+        self.assertEqual(bible_fuzzy.deletes(u'abc', 1),
+            set([u'abc', u'bc', u'ac', u'ab']))
+        self.assertEqual(bible_fuzzy.deletes(u'abc', 0), set([u'abc']))
+
+    def test_book_query(self):
+        self.assertEqual(bible_fuzzy.book_query(u'; genisis. '), u'genisis')
+        self.assertEqual(bible_fuzzy.book_query(u' and 1 jn'), u'1 jn')
+
+
+class FuzzyIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = bible_fuzzy.FuzzyIndex(names)
+
+    def test_exact(self):
+        self.assertEqual(self.index.find(u'john'), (43, u'john', 1.0))
+
+    def test_typos(self):
+        number, name, confidence = self.index.find(u'genisis')
+        self.assertEqual((number, name), (1, u'genesis'))
+        self.assertAlmostEqual(confidence, 1 - 1 / 7.0)
+        number, name, confidence = self.index.find(u'phillipians')
+        self.assertEqual((number, name), (50, u'philippians'))
+        self.assertTrue(confidence < 1.0)
+
+    def test_too_far(self):
+        self.assertEqual(self.index.find(u'genxxxx'), None)
+        self.assertEqual(self.index.find(u'mama'), None)
+
+    def test_short_names_exact_only(self):
+        # anything would be one typo from a two-letter abbreviation
+        self.assertEqual(self.index.find(u'jx'), None)
+        self.assertEqual(self.index.find(u'ex'), (2, u'ex', 1.0))
+
+    def test_tie_splits_confidence(self):
+        # one typo from two books
+        index = bible_fuzzy.FuzzyIndex({u'abcdef': 1, u'abcdeg': 2})
+        number, name, confidence = index.find(u'abcdex')
+        self.assertAlmostEqual(confidence, (1 - 1 / 6.0) / 2)
+
+    def test_results_kept(self):
+        index = bible_fuzzy.FuzzyIndex(names, max_results=2)
+        first = index.find(u'genisis')
+        self.assertTrue(index.find(u'genisis') is first)
+        index.find(u'exodos')
+        index.find(u'jonha')
+        self.assertTrue(len(index._results) <= 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#test_bible_paragraphs.py
+import unittest
+
+import bible_paragraphs
+import bible_parser
+from tests import verses
+
+references = [u'Gen 1', u'Gen 1:2', u'Gen 1:3-6', u'Gen 1:4-2:2',
+    u'Gen 1\u20132', u'Gen 2:2-3', u'Ps 117', u'Ps 117:2']
+
+
+class AssembleTest(unittest.TestCase):
+    def setUp(self):
+        self.db = verses.VerseDb()
+        crp = bible_parser.CrossReferenceParser()
+        self.crefs = [list(crp.parse(crp.tokenize(reference)))[0]
+            for reference in references]
+
+    def tearDown(self):
+        self.db.close()
+
+    def whole(self, cref):
+        return cref.passage_document(cref.verse_xml())
+
+    def test_same_as_xslt(self):
+        self.assertEqual(bible_paragraphs.compare_to_xslt(self.crefs), [])
+        for cref in self.crefs:
+            self.assertEqual(
+                u''.join(bible_paragraphs.assemble([self.whole(cref)])),
+                cref.orient_to_paragraph(cref.verse_xml(),
+                    ['paragraph.xsl']).decode('utf-8'), cref.pretty_cref())
+
+    def test_streamed(self):
+        for cref in self.crefs:
+            for rows_per_fetch in (1, 2, 100):
+                self.assertEqual(u''.join(bible_paragraphs.assemble(
+                    cref.iter_passage_document(rows_per_fetch))),
+                    u''.join(bible_paragraphs.assemble([self.whole(cref)])),
+                    cref.pretty_cref())
+
+    def test_split_anywhere(self):
+        for cref in self.crefs[:4]:
+            document = self.whole(cref)
+            expected = u''.join(bible_paragraphs.assemble([document]))
+            for i in range(len(document) + 1):
+                self.assertEqual(u''.join(bible_paragraphs.assemble(
+                    [document[:i], document[i:]])), expected,
+                    '%s split at %d' % (cref.pretty_cref(), i))
+            self.assertEqual(u''.join(bible_paragraphs.assemble(
+                list(document))), expected)
+
+    def test_empty_paragraph(self):
+        document = u'<passage>\n<passage-reference>R</passage-reference>\n' \
+            u'<paragraph-start class="body"/>a<paragraph-end/>\n' \
+            u'<paragraph-start class="body"/><paragraph-end/></passage>'
+        self.assertEqual(u''.join(bible_paragraphs.assemble([document])),
+            u'<passage><passage-reference>R</passage-reference>'
+            u'<paragraph class="body">a</paragraph>'
+            u'<paragraph class="body"/></passage>')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+#test_bible_parser.py
+import json
+import os
+import sqlite3
+import unittest
+
+import bible_books
+import bible_cache
+import bible_parser
+from tests import verses
+
+
+class PlainTextTest(unittest.TestCase):
+    def setUp(self):
+        self.db = verses.VerseDb()
+        self.crp = bible_parser.CrossReferenceParser()
+
+    def tearDown(self):
+        self.db.close()
+
+    def cref(self, reference):
+        return list(self.crp.parse(self.crp.tokenize(reference)))[0]
+
+    def test_verse_number_left_out(self):
+        lines = self.cref(u'Gen 1:1-2').text().decode('utf-8').split(u'\n')
+        self.assertEqual(lines[1], u'1 In the beginning God created the '
+            u'heavens and the earth.')
+        self.assertEqual(lines[2], u'2 The earth was formless and empty, '
+            u'and darkness covered the deep waters.')
+
+    def test_nbs_is_a_space(self):
+        text = self.cref(u'Gen 1:6').passage_dict()['verses'][0]['text']
+        self.assertTrue(text.startswith(u'Then God said, “Let there be a '
+            u'space'))
+
+    def test_note_left_out(self):
+        text = self.cref(u'Gen 1:4').passage_dict()['verses'][0]['text']
+        self.assertEqual(text, u'And God saw that the light was good. Then '
+            u'he separated the light from the darkness.')
+
+    def test_markup_and_entities(self):
+        passage = json.loads(self.cref(u'Ps 117').json())
+        self.assertEqual([verse['text'] for verse in passage['verses']], [
+            u'Praise the Lord, all you nations.',
+            u'For he loves us with unfailing love; the Lord’s faithfulness '
+                u'endures forever.'])
+        text = self.cref(u'Gen 1:7').text().decode('utf-8')
+        self.assertTrue(text.endswith(u'the waters & the sky.'))
+
+
+class ParseManyTest(unittest.TestCase):
+    def setUp(self):
+        self.crp = bible_parser.CrossReferenceParser()
+
+    def test_unparseable_inputs(self):
+        inputs = [u'John 3:16', u'', u'John', u'f', u'Gen 1:1', u'John']
+        results = list(self.crp.parse_many(inputs))
+        self.assertEqual([reference_string for reference_string, crefs, error
+            in results], inputs)
+        for reference_string, crefs, error in results:
+            if reference_string in (u'John 3:16', u'Gen 1:1'):
+                self.assertEqual(len(crefs), 1)
+                self.assertEqual(error, None)
+            else:
+                self.assertEqual(crefs, [])
+                self.assertTrue(isinstance(error, bible_parser.VerseError))
+
+
+class BookConfidenceTest(unittest.TestCase):
+    def setUp(self):
+        # the service's parser, with the Spanish names
+        import rest
+        self.crp = rest.crp
+        self.fuzzy_confidence = \
+            bible_parser.BibleCrossReference.fuzzy_confidence
+
+    def tearDown(self):
+        bible_parser.BibleCrossReference.fuzzy_confidence = \
+            self.fuzzy_confidence
+
+    def cref(self, reference):
+        return list(self.crp.parse(self.crp.tokenize(reference)))[0]
+
+    def test_off_by_default(self):
+        self.assertEqual(bible_parser.BibleCrossReference.fuzzy_confidence,
+            None)
+
+    def test_exact_names(self):
+        for reference in [u'John 3:16', u'1 Cor 13', u'Ps. 23',
+                u'Juan 3:16', u'Song of Songs 2', u'2\u00a0Cor 5:17']:
+            self.assertEqual(self.cref(reference).book_confidence, 1.0,
+                reference)
+
+    def test_partial_match_not_sure(self):
+        # a name found inside the token, the way it always has been
+        cref = self.cref(u'Genisis 1:1')
+        self.assertEqual(cref.pretty_cref(), u'Genesis 1:1')
+        self.assertTrue(cref.book_confidence < 0.5)
+        cref = self.cref(u'Mam\u00e1 1:1')
+        self.assertEqual(cref.pretty_cref(), u'Amos 1:1')
+        self.assertTrue(cref.book_confidence < 1.0)
+
+    def test_fuzzy(self):
+        bible_parser.BibleCrossReference.fuzzy_confidence = 0.7
+        cref = self.cref(u'Genisis 1:1')
+        self.assertEqual(cref.pretty_cref(), u'Genesis 1:1')
+        self.assertAlmostEqual(cref.book_confidence, 1 - 1 / 7.0)
+        cref = self.cref(u'Phillipians 4:13')
+        self.assertEqual(cref.pretty_cref(), u'Philippians 4:13')
+        self.assertTrue(0.7 <= cref.book_confidence < 1.0)
+        self.assertEqual(self.cref(u'John 3:16').book_confidence, 1.0)
+        self.assertRaises(bible_parser.VerseError,
+            self.cref(u'Mam\u00e1 1:1').pretty_cref)
+
+
+class PassageDocumentTest(unittest.TestCase):
+    def setUp(self):
+        self.db = verses.VerseDb()
+        self.crp = bible_parser.CrossReferenceParser()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_streamed_same_as_whole(self):
+        # across the chapters, starting and ending inside paragraphs and
+        # at their edges
+        for reference in [u'Gen 1:4-2:2', u'Gen 1\u20132', u'Gen 1:7-2:1',
+                u'Gen 1:2-2:3', u'Gen 1:6-2:2']:
+            cref = list(self.crp.parse(self.crp.tokenize(reference)))[0]
+            whole = cref.passage_document(cref.verse_xml())
+            for rows_per_fetch in (1, 2, 100):
+                self.assertEqual(
+                    ''.join(cref.iter_passage_document(rows_per_fetch)),
+                    whole, '%s, %d rows at a time' % (reference,
+                        rows_per_fetch))
+
+
+class PassageVersionsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = verses.VerseDb()
+        crp = bible_parser.CrossReferenceParser()
+        self.cref = list(crp.parse(crp.tokenize(u'Ps 117')))[0]
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_versions(self):
+        passages = self.cref.get_passage_versions(['nlt', 'NLT'])
+        self.assertEqual(sorted(passages), ['NLT', 'nlt'])
+        self.assertEqual([verse['verse_num'] for verse in passages['nlt']],
+            [1, 2])
+
+    def test_missing_version(self):
+        errors = {}
+        passages = self.cref.get_passage_versions(['nlt', 'nope'], errors)
+        self.assertEqual(sorted(passages), ['nlt'])
+        self.assertEqual(len(passages['nlt']), 2)
+        self.assertEqual(sorted(errors), ['nope'])
+        self.assertTrue(isinstance(errors['nope'], sqlite3.Error))
+        # without errors, the bad version is just left out
+        self.assertEqual(sorted(self.cref.get_passage_versions(
+            ['nope', 'nlt'])), ['nlt'])
+
+
+class CacheKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.db = verses.VerseDb()
+        self.english = bible_parser.CrossReferenceParser(
+            book_name_binder=bible_books.BookNameBinder([
+                bible_books.book_name_system(bible_books.THPFullName),
+                bible_books.book_name_system(
+                    bible_books.THPSpanishFullName)]))
+        self.spanish = bible_parser.CrossReferenceParser(
+            book_name_binder=bible_books.BookNameBinder([
+                bible_books.book_name_system(
+                    bible_books.THPSpanishFullName)]))
+        # xml() without the stylesheets
+        self.native_paragraphs = \
+            bible_parser.BibleCrossReference.native_paragraphs
+        bible_parser.BibleCrossReference.native_paragraphs = True
+
+    def tearDown(self):
+        bible_parser.BibleCrossReference.native_paragraphs = \
+            self.native_paragraphs
+        self.db.close()
+
+    def cref(self, parser, reference):
+        return list(parser.parse(parser.tokenize(reference)))[0]
+
+    def test_binders_rendered_apart(self):
+        english = self.cref(self.english, u'Genesis 1:1')
+        spanish = self.cref(self.spanish, u'G\u00e9nesis 1:1')
+        self.assertEqual(english.cache_key('rows'), spanish.cache_key('rows'))
+        self.assertNotEqual(english.cache_key('xml'),
+            spanish.cache_key('xml'))
+        self.assertTrue('<passage-reference>Genesis 1:1<' in english.xml())
+        self.assertTrue('<passage-reference>G\xc3\xa9nesis 1:1<' in
+            spanish.xml())
+
+    def test_db_in_every_key(self):
+        cref = self.cref(self.english, u'Genesis 1:1')
+        keys = cref.cache_key('rows'), cref.cache_key('xml')
+        self.db.close()
+        self.db = verses.VerseDb()
+        self.assertNotEqual(cref.cache_key('rows'), keys[0])
+        self.assertNotEqual(cref.cache_key('xml'), keys[1])
+
+
+# one passage comes out as two elements, another as nothing at all
+uneven_xsl = '''<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:template match="passage[passage-reference='Genesis 1:2']">
+  <title><xsl:value-of select="passage-reference"/></title>
+  <passage/>
+</xsl:template>
+<xsl:template match="passage[passage-reference='Genesis 1:3']"/>
+</xsl:stylesheet>
+'''
+
+
+class XmlBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.db = verses.VerseDb()
+        fl = open(os.path.join(bible_parser.xsl_dir, 'uneven.xsl'), 'w')
+        fl.write(uneven_xsl)
+        fl.close()
+        crp = bible_parser.CrossReferenceParser()
+        self.crefs = [list(crp.parse(crp.tokenize(reference)))[0]
+            for reference in [u'Gen 1:1', u'Gen 1:2', u'Ps 118', u'Gen 1:3',
+                u'Gen 1:4-2:2', u'Ps 117', u'Gen 1:1']]
+
+    def tearDown(self):
+        self.db.close()
+
+    def one_at_a_time(self, included_stylesheets):
+        bible_cache.passage_cache.clear()
+        results = []
+        for cref in self.crefs:
+            try:
+                results.append((cref.xml(included_stylesheets), None))
+            except bible_parser.VerseError as X:
+                results.append((None, X))
+        bible_cache.passage_cache.clear()
+        return results
+
+    def check(self, included_stylesheets):
+        expected = self.one_at_a_time(included_stylesheets)
+        results = bible_parser.xml_batch(self.crefs, included_stylesheets)
+        self.assertEqual([xml for xml, error in results],
+            [xml for xml, error in expected])
+        self.assertEqual([error.__class__ for xml, error in results],
+            [error.__class__ for xml, error in expected])
+        self.assertTrue(isinstance(results[2][1], bible_parser.VerseError))
+
+    def test_same_as_xml(self):
+        self.check(['paragraph.xsl'])
+
+    def test_uneven_results(self):
+        self.check(['paragraph.xsl', 'uneven.xsl'])
+        results = bible_parser.xml_batch(self.crefs,
+            ['paragraph.xsl', 'uneven.xsl'])
+        self.assertEqual(results[1][0],
+            '<title>Genesis 1:2</title><passage/>')
+        self.assertEqual(results[3][0], '')
+        self.assertTrue(results[4][0].startswith(
+            '<passage><passage-reference>Genesis 1:4'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#test_bible_snapshot.py
+import cPickle
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+import bible_books
+import bible_snapshot
+
+systems = [bible_books.THPFullName,
+    (bible_books.THPBibleTeamAbbr, {'nbs': u'\u00a0'})]
+# the systems rest.py uses
+rest_systems = [bible_books.THPFullName, bible_books.THPFullNameSongs,
+    bible_books.THPBibleTeamAbbr, bible_books.THPNLTSBAbbr,
+    bible_books.THPSpanishFullName, bible_books.THPSpanishBibleTeamAbbr]
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'binder.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        made = bible_snapshot.binder(self.path, systems)
+        self.assertTrue(os.path.exists(self.path))
+        loaded = bible_snapshot.load(self.path)
+        self.assertEqual(loaded.book_name_systems, made.book_name_systems)
+        self.assertEqual(loaded.fingerprint(), made.fingerprint())
+        self.assertEqual(loaded.book_name_to_number(),
+            made.book_name_to_number())
+        pattern = loaded.book_name_pattern()
+        self.assertEqual((pattern.pattern, pattern.flags),
+            (made.book_name_pattern().pattern,
+                made.book_name_pattern().flags))
+        # it matches lookup keys (see bible_books.lookup_key)
+        self.assertTrue(pattern.match(bible_books.lookup_key(u'1 John')))
+
+    def test_plain_data(self):
+        bible_snapshot.binder(self.path, systems)
+        fl = open(self.path, 'rb')
+        data = cPickle.load(fl)
+        fl.close()
+        source, flags = data['pattern']
+        self.assertTrue(isinstance(source, basestring))
+        self.assertEqual(re.compile(source, flags).pattern, source)
+        self.assertEqual([name for name, options in data['systems']],
+            ['THPFullName', 'THPBibleTeamAbbr'])
+
+    def test_no_path(self):
+        binder = bible_snapshot.binder(None, systems)
+        self.assertEqual(len(binder.book_name_systems), 2)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_out_of_date(self):
+        bible_snapshot.binder(self.path, systems)
+        fl = open(self.path, 'rb')
+        data = cPickle.load(fl)
+        fl.close()
+        data['format'] = bible_snapshot.format_version - 1
+        fl = open(self.path, 'wb')
+        cPickle.dump(data, fl)
+        fl.close()
+        self.assertRaises(bible_snapshot.SnapshotError, bible_snapshot.load,
+            self.path)
+        # binder() makes it again
+        bible_snapshot.binder(self.path, systems)
+        bible_snapshot.load(self.path)
+
+
+class SnapshotTimeTest(unittest.TestCase):
+    """
+    Loading has to beat making the binder, each starting from nothing
+    (no shared systems, derived values or cached regex)
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'binder.snapshot')
+        bible_snapshot.binder(self.path, rest_systems)
+        self.shared = dict(bible_books._systems), dict(bible_books._derived)
+
+    def tearDown(self):
+        bible_books._systems.clear()
+        bible_books._systems.update(self.shared[0])
+        bible_books._derived.clear()
+        bible_books._derived.update(self.shared[1])
+        shutil.rmtree(self.directory)
+
+    def time(self, make):
+        best = None
+        for i in range(5):
+            bible_books._systems.clear()
+            bible_books._derived.clear()
+            re.purge()
+            started = time.time()
+            binder = make()
+            binder.book_list()
+            binder.book_name_to_number()
+            binder.book_name_pattern()
+            binder.fingerprint()
+            seconds = time.time() - started
+            if best is None or seconds < best:
+                best = seconds
+        return best
+
+    def test_load_faster_than_making(self):
+        made = self.time(lambda: bible_snapshot.binder(None, rest_systems))
+        loaded = self.time(lambda: bible_snapshot.load(self.path))
+        self.assertTrue(loaded < made, 'loaded in %.2fms, made in %.2fms' %
+            (loaded * 1000, made * 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+#test_bible_versification.py
+import imp
+import os
+import unittest
+
+import bible_parser
+from tests import verses
+
+
+class VersificationTest(unittest.TestCase):
+    def setUp(self):
+        self.db = verses.VerseDb()
+        self.crp = bible_parser.CrossReferenceParser()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_imports_from_source(self):
+        # from the .py, so a stale .pyc can't hide a syntax error
+        import bible_versification
+        path = os.path.splitext(bible_versification.__file__)[0] + '.py'
+        module = imp.load_source('bible_versification_source', path)
+        self.assertTrue(hasattr(module, 'Versification'))
+
+    def test_chapter_end(self):
+        cref = list(self.crp.parse(self.crp.tokenize(u'Ps 117')))[0]
+        passage = cref.get_passage()
+        self.assertEqual([verse['verse_num'] for verse in passage], [1, 2])
+
+    def test_whole_chapter(self):
+        cref = list(self.crp.parse(self.crp.tokenize(u'Gen 1')))[0]
+        self.assertEqual(cref.get_passage()[-1]['verse_num'], 7)
+
+    def test_missing_chapter(self):
+        cref = list(self.crp.parse(self.crp.tokenize(u'Ps 118')))[0]
+        self.assertRaises(bible_parser.VerseError, cref.get_passage)
+
+
+if __name__ == '__main__':
+    unittest.main()
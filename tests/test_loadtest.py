@@ -0,0 +1,60 @@
+#test_loadtest.py
+import StringIO
+import sys
+import threading
+import unittest
+
+import loadtest
+import rest
+import rest_server
+
+
+class LoadTestTest(unittest.TestCase):
+    def test_mix_parses_as_expected(self):
+        for kind, reference in loadtest.make_references(2000):
+            try:
+                rest.pretty_crefs(reference)
+                parsed = True
+            except Exception:
+                parsed = False
+            self.assertEqual(parsed, kind != 'invalid',
+                '%s reference %r' % (kind, reference))
+
+    def test_same_seed_same_mix(self):
+        self.assertEqual(loadtest.make_references(200, seed=3),
+            loadtest.make_references(200, seed=3))
+
+    def test_unexpected_statuses(self):
+        test = loadtest.LoadTest('127.0.0.1', 0, [])
+        test.results = [('english', 200, 0.01), ('invalid', 500, 0.01),
+            ('english', 500, 0.01), ('invalid', 200, 0.01),
+            ('hot', None, 0.01)]
+        summary = test.summary(1.0)
+        self.assertEqual(summary['unexpected'],
+            {'english': 1, 'invalid': 1, 'hot': 1})
+        out = StringIO.StringIO()
+        loadtest.print_summary(summary, out)
+        self.assertTrue('UNEXPECTED' in out.getvalue())
+
+    def test_run_against_service(self):
+        server = rest_server.make_server('127.0.0.1', 0, rest.app.wsgifunc())
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        # the service writes a traceback for every invalid reference
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            test = loadtest.LoadTest('127.0.0.1', server.server_address[1],
+                loadtest.make_references(300), concurrency=4)
+            summary = test.summary(test.run())
+        finally:
+            sys.stderr = stderr
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.assertEqual(summary['requests'], 300)
+        self.assertEqual(summary['unexpected'], {})
+        self.assertTrue(summary['statuses'].get('500'))
+
+
+if __name__ == '__main__':
+    unittest.main()
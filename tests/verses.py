@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#verses.py
+"""
+A small verse db for the tests, laid out like the real one: a table per
+version, with each verse's text as the db's verse-oriented xml (verse
+numbers, paragraph markers, <nbs/> and notes in the text).
+The production stylesheets aren't in the tree, so it comes with a stand-in
+paragraph.xsl that groups the paragraph markers the way assemble() does.
+
+usage:
+db = VerseDb()  # points bible_parser at it, and at the stand-in stylesheets
+...
+db.close()
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import bible_cache
+import bible_parser
+
+# (book, chapter, verse, verse_text)
+rows = [
+    (1, 1, 1, u'<paragraph-start class="body"/><verse-number>1</verse-number>'
+        u'In the beginning God created the heavens and the earth.'),
+    (1, 1, 2, u'<verse-number>2</verse-number>The earth was formless and '
+        u'empty, and darkness covered the deep waters.<paragraph-end/>'),
+    (1, 1, 3, u'<paragraph-start class="body"/><verse-number>3</verse-number>'
+        u'Then God said, “Let there be light,” and there was '
+        u'light.'),
+    (1, 1, 4, u'<verse-number>4</verse-number>And God saw that the light '
+        u'was good.<note class="footnote">Or <i>beautiful</i>.</note> Then '
+        u'he separated the light from the darkness.'),
+    (1, 1, 5, u'<verse-number>5</verse-number>God called the light '
+        u'“day” and the darkness “night.”<paragraph-end/>'),
+    (1, 1, 6, u'<paragraph-start class="body"/><verse-number>6</verse-number>'
+        u'Then God said, “Let there<nbs/>be a space between the waters, '
+        u'to separate the waters of the heavens from the waters of the '
+        u'earth.”'),
+    (1, 1, 7, u'<verse-number>7</verse-number>And that is what happened. '
+        u'God made this space to separate the waters &amp; the sky.'
+        u'<paragraph-end/>'),
+    (1, 2, 1, u'<paragraph-start class="body"/><verse-number>1</verse-number>'
+        u'So the creation of the heavens and the earth and everything in '
+        u'them was completed.'),
+    (1, 2, 2, u'<verse-number>2</verse-number>On the seventh day God had '
+        u'finished his work of creation, so he rested from all his work.'),
+    (1, 2, 3, u'<verse-number>3</verse-number>And God blessed the seventh '
+        u'day and declared it holy.<paragraph-end/>'),
+    (19, 117, 1, u'<paragraph-start class="body"/>'
+        u'<verse-number>1</verse-number>Praise the L<sc>ord</sc>, all you '
+        u'nations.'),
+    (19, 117, 2, u'<verse-number>2</verse-number>For he loves us with '
+        u'unfailing love; the L<sc>ord</sc>’s faithfulness endures '
+        u'forever.<paragraph-end/>'),
+    ]
+
+copy_all_xsl = '''<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:template match="@*|node()">
+  <xsl:copy><xsl:apply-templates select="@*|node()"/></xsl:copy>
+</xsl:template>
+</xsl:stylesheet>
+'''
+
+# each paragraph-start and what follows it, up to its paragraph-end, as a
+# <paragraph>; anything outside the paragraphs is left out
+paragraph_xsl = '''<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:key name="in-para"
+    match="node()[not(self::paragraph-start or self::paragraph-end)]"
+    use="generate-id(preceding-sibling::paragraph-start[1])"/>
+<xsl:template match="passage">
+  <passage><xsl:apply-templates
+    select="passage-reference | paragraph-start"/></passage>
+</xsl:template>
+<xsl:template match="paragraph-start">
+  <xsl:variable name="ends" select="count(preceding-sibling::paragraph-end)"/>
+  <paragraph class="{@class}"><xsl:apply-templates
+    select="key('in-para', generate-id())[count(preceding-sibling::paragraph-end) = $ends]"/></paragraph>
+</xsl:template>
+</xsl:stylesheet>
+'''
+
+
+class VerseDb():
+    """
+    Makes the db in a temporary directory and points bible_parser at it
+    """
+    def __init__(self, version='nlt'):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'bible.db')
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE %s (Id INTEGER PRIMARY KEY, '
+            'book_num INTEGER, chapter_num INTEGER, verse_num INTEGER, '
+            'verse_text TEXT, class_context TEXT, see TEXT)' % version)
+        for i, (book, chapter, verse, text) in enumerate(rows):
+            connection.execute('INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?)' %
+                version, (i + 1, book, chapter, verse, text,
+                    'paragraph.body', None))
+        connection.commit()
+        connection.close()
+        xsl_dir = os.path.join(self.directory, 'xsl')
+        os.mkdir(xsl_dir)
+        for name, text in [('copy_all.xsl', copy_all_xsl),
+                ('paragraph.xsl', paragraph_xsl)]:
+            fl = open(os.path.join(xsl_dir, name), 'w')
+            fl.write(text)
+            fl.close()
+        self.db_path = bible_parser.db_path
+        self.xsl_dir = bible_parser.xsl_dir
+        bible_parser.db_path = self.path
+        bible_parser.xsl_dir = xsl_dir
+        bible_parser._stylesheets.clear()
+        bible_cache.passage_cache.clear()
+
+    def close(self):
+        bible_parser.db_path = self.db_path
+        bible_parser.xsl_dir = self.xsl_dir
+        bible_parser._stylesheets.clear()
+        bible_cache.passage_cache.clear()
+        shutil.rmtree(self.directory)